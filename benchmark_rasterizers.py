@@ -0,0 +1,81 @@
+import argparse
+import time
+from copy import deepcopy
+
+import numpy as np
+from lxml import etree as et
+
+import tei_to_svg     # registers the fonts that tei_to_svg lays text out in
+from util import load_json
+from svg_to_mp4 import FrameRenderer
+from svg_snapshot import get_frame_range
+from svg_rasterizers import RASTERIZERS
+
+# pixels that differ by more than this much (in any channel, out of 255)
+# count as visibly different
+DIFFERENCE_THRESHOLD = 16
+
+def benchmark(svg_tree, config, names, begin_time, end_time, fps):
+    """ Renders the same frames of an SVG animation with each of the rasterizers
+        in names, returning, for each, its frames per second and how different its
+        frames are from those of the first one:
+            (name, fps, mean difference, max difference, fraction of pixels visibly different) """
+
+    first_frame, last_frame = get_frame_range(begin_time, end_time, fps)
+    # frames from the frame cache would time reading them, not rasterizing them
+    config = { key: value for key, value in config.items() if key != "frame-cache" }
+    renderers = [ FrameRenderer(deepcopy(svg_tree), dict(config, rasterizer=name), fps)
+                    for name in names ]
+    frame_sources = [ renderer.render(first_frame, last_frame) for renderer in renderers ]
+    seconds = [ 0.0 ] * len(names)
+    mean_diffs = [ 0.0 ] * len(names)
+    max_diffs = [ 0 ] * len(names)
+    different = [ 0.0 ] * len(names)
+    num_frames = 0
+
+    # render the frames side by side, so we don't have to keep them all around
+    while True:
+        frames = []
+        for i, frame_source in enumerate(frame_sources):
+            begin = time.perf_counter()
+            frames.append(next(frame_source, None))
+            seconds[i] += time.perf_counter() - begin
+        if frames[0] is None:
+            break
+        num_frames += 1
+        reference = frames[0].astype(np.int16)
+        for i, frame in enumerate(frames):
+            diff = np.abs(frame - reference)
+            mean_diffs[i] += diff.mean()
+            max_diffs[i] = max(max_diffs[i], int(diff.max()))
+            different[i] += (diff.max(axis=2) > DIFFERENCE_THRESHOLD).mean()
+
+    num_frames = max(num_frames, 1)
+    return [ (name, num_frames / max(seconds[i], 1e-9), mean_diffs[i] / num_frames,
+              max_diffs[i], different[i] / num_frames) for i, name in enumerate(names) ]
+
+def main(input_filename, config_filename, names, begin_time, end_time, fps):
+    svg_tree = et.parse(input_filename).getroot()
+    config = load_json(config_filename) if config_filename else {}
+    fps = fps or config.get("fps", 30)
+    results = benchmark(svg_tree, config, names, begin_time, end_time, fps)
+
+    print(f"{'rasterizer':<12}{'frames/sec':>12}{'mean diff':>12}{'max diff':>10}{'different':>12}")
+    for name, frames_per_second, mean_diff, max_diff, different in results:
+        print(f"{name:<12}{frames_per_second:>12.1f}{mean_diff:>12.3f}{max_diff:>10}{different:>11.2%}")
+    print(f"(differences are against {names[0]}; 'different' is the fraction of pixels "
+          f"off by more than {DIFFERENCE_THRESHOLD})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the speed and output of the SVG rasterizers on an SVG animation')
+    parser.add_argument('input', type=str, help='Input .svg file')
+    parser.add_argument('config', type=str, nargs="?", default="", help="Config JSON file")
+    parser.add_argument('--rasterizers', type=str, nargs="+", default=list(RASTERIZERS),
+                        choices=list(RASTERIZERS), help="Rasterizers to compare; the first is the reference")
+    parser.add_argument('--begin', type=float, default=0.0, help="Time to start at (in seconds) [default=0]")
+    parser.add_argument('--end', type=float, default=3.0, help="Time to end at (in seconds) [default=3]")
+    parser.add_argument('--fps', type=int, default=0, help="Frames per second [default: from the config, or 30]")
+    args = parser.parse_args()
+    main(args.input, args.config, args.rasterizers, args.begin, args.end, args.fps)
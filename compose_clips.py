@@ -1,10 +1,38 @@
 
+import os
 import argparse
+import logging
+import tempfile
+import subprocess
 import moviepy.editor as mp
+from moviepy.config import get_setting
 
+from svg_to_mp4 import get_video_info, can_join_videos, crossfade_videos, get_fade_frames
+from render_job import get_jobs_dir
 
 
-def compose_clips(clip_paths, output_path, fade_duration=0.5):
+# mix_audio uses adelay's all= option (new in ffmpeg 4.4) and amix's normalize=
+# option (new in ffmpeg 5.1)
+MIN_FFMPEG_VERSION = "5.1"
+
+def mix_audio(clip_paths, start_times, duration, output_path):
+    """ Mixes the clips' audio, each starting at its start time (in seconds),
+        into one audio file, padded with silence out to duration (in seconds).
+        Needs ffmpeg MIN_FFMPEG_VERSION or later. """
+    command = [ get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error" ]
+    for clip_path in clip_paths:
+        command += [ "-i", clip_path ]
+    filters = [ f"[{idx}:a]adelay=delays={round(start_time * 1000)}:all=1[a{idx}]"
+                    for idx, start_time in enumerate(start_times) ]
+    inputs = "".join(f"[a{idx}]" for idx in range(len(clip_paths)))
+    filters.append(f"{inputs}amix=inputs={len(clip_paths)}:normalize=0:duration=longest,"
+                   f"apad=whole_dur={duration}[a]")
+    command += [ "-filter_complex", ";".join(filters), "-map", "[a]", output_path ]
+    if subprocess.run(command).returncode:
+        raise Exception(f"ffmpeg failed writing {output_path}")
+    return output_path
+
+def compose_clips_reencoded(clip_paths, output_path, fade_duration=0.5):
     clips = []
     current_time = 0
     max_fps = 1
@@ -21,6 +49,49 @@ def compose_clips(clip_paths, output_path, fade_duration=0.5):
     video = mp.CompositeVideoClip(clips)
     video.write_videofile(output_path, audio_codec='aac', fps=max_fps)
 
+def compose_clips(clip_paths, output_path, fade_duration=0.5, work_dir=""):
+    """ Puts the clips one after the other, each fading in over the end of the
+        one before.  If the clips were all encoded the same way (e.g. they're all
+        from svg_to_mp4 or tei_to_mp4 with the same config), only the fades are
+        encoded again and the rest is copied as it is; otherwise the whole thing
+        is encoded again. """
+
+    infos = [ get_video_info(clip_path) for clip_path in clip_paths ]
+    if not can_join_videos(infos):
+        logging.warning("The clips aren't all encoded the same way, so they all have "
+                        "to be encoded again")
+        return compose_clips_reencoded(clip_paths, output_path, fade_duration)
+
+    fps = infos[0]["fps"]
+    fade_frames = round(fade_duration * fps)
+    jobs_dir = get_jobs_dir(work_dir)
+    os.makedirs(jobs_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=jobs_dir) as scratch_dir:
+        # the audio overlaps (and is mixed) during the fades, same as the video
+        # (including fades shortened for short clips); clips without any audio 
+        # are just silent for as long as they're on
+        start_times, current_frame = [], 0
+        for idx, info in enumerate(infos):
+            if idx > 0:
+                current_frame -= get_fade_frames(infos[idx - 1]["frames"], info["frames"], fade_frames)
+            start_times.append(current_frame / fps)
+            current_frame += info["frames"]
+        audio_paths = [ clip_path for clip_path, info in zip(clip_paths, infos) if info["audio"] ]
+        audio_starts = [ start_time for start_time, info in zip(start_times, infos) if info["audio"] ]
+        if audio_paths and len(audio_paths) < len(clip_paths):
+            logging.warning(f"{len(clip_paths) - len(audio_paths)} of the clips have no audio; "
+                            f"they'll be silent")
+        audio_path = ""
+        if audio_paths:
+            try:
+                audio_path = mix_audio(audio_paths, audio_starts, current_frame / fps,
+                                       os.path.join(scratch_dir, "audio.wav"))
+            except Exception as e:
+                logging.warning(f"{e} (mixing the audio needs ffmpeg {MIN_FFMPEG_VERSION} "
+                                f"or later), so the clips all have to be encoded again")
+                return compose_clips_reencoded(clip_paths, output_path, fade_duration)
+        crossfade_videos(clip_paths, output_path, fade_frames, scratch_dir, audio_path, infos)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Combine movie clips with 1s crossfade')
@@ -28,5 +99,7 @@ if __name__ == '__main__':
                     help='The clips to combine')
     parser.add_argument("--output_path", type=str, help="The output clip")
     parser.add_argument("--fade_duration", type=float, default=0.5, help="The duration of the crossfade, in seconds [default=0.5]")
+    parser.add_argument("--work-dir", type=str, default="", 
+                        help="Where to put temporary files, or 'tmpfs' for a RAM disk [default=temp/jobs]")
     args = parser.parse_args()
-    compose_clips(args.input_paths, args.output_path, args.fade_duration)
\ No newline at end of file
+    compose_clips(args.input_paths, args.output_path, args.fade_duration, args.work_dir)
\ No newline at end of file
@@ -0,0 +1,141 @@
+#################
+#
+# An on-disk cache of rendered frames, shared between renders.
+#
+# A frame is looked up by a fingerprint of what it shows: the snapshot of
+# the SVG at that moment (canonicalized, so that the order attributes
+# happen to be in doesn't matter) and the settings it's rendered with
+# (size, background, rasterizer...).  So when the same book is rendered
+# again after a small change (new audio, a different fps, a typo fixed on
+# one page), the frames that come out the same don't have to be rendered.
+#
+# Frames are stored uncompressed, as .npy files, since reading them back
+# has to be a lot faster than rendering them.  The cache is kept under a
+# size limit by removing the least recently used frames; a frame's
+# modification time is when it was last used.  Several processes (and
+# several renders) can use the same cache directory: frames are written
+# under a temporary name and renamed, so nobody reads half a frame.
+#
+#################
+
+import os
+import re
+import json
+import hashlib
+import logging
+
+import numpy as np
+from lxml import etree as et
+
+from svg_snapshot import GENERATED_ID_PREFIX
+
+DEFAULT_CACHE_SIZE_MB = 10000
+
+# when over its size limit, the cache is trimmed down to this fraction of
+# it, so it isn't scanned again on every frame written
+EVICTION_TARGET = 0.9
+
+# the ids SnapshotSVG gives animated elements depend on what else it's seen
+# in the same process, and don't change how anything looks
+GENERATED_ID = re.compile(f' id="{GENERATED_ID_PREFIX}[0-9]+"'.encode("utf-8"))
+
+def get_fingerprint(svg, settings_bytes):
+    """ A fingerprint of a snapshot of the SVG, rendered with settings_bytes """
+    hasher = hashlib.sha256(settings_bytes)
+    hasher.update(GENERATED_ID.sub(b"", et.tostring(svg, method="c14n")))
+    return hasher.hexdigest()
+
+def get_render_settings(config):
+    """ Everything in the config that changes how a frame looks, given the same
+        snapshot, as bytes to go into its fingerprint """
+    settings = { key: config.get(key) for key in
+                    ("width", "height", "scale", "bg-color", "rasterizer", "alpha") }
+    bg_filename = config.get("bg-image", "")
+    if bg_filename:
+        settings["bg-image"] = os.path.abspath(bg_filename)
+        settings["bg-image-mtime"] = os.path.getmtime(bg_filename)
+    return json.dumps(settings, sort_keys=True).encode("utf-8")
+
+
+class FrameCache:
+    """ Frames (RGB arrays) on disk in cache_dir, by fingerprint, keeping the
+        most recently used ones up to max_bytes """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.dir, exist_ok=True)
+        self.size = sum(size for _, _, size in self.list_frames())
+
+    def get_path(self, key):
+        return os.path.join(self.dir, key[:2], key + ".npy")
+
+    def list_frames(self):
+        """ (path, last used, size) for each frame in the cache """
+        frames = []
+        for subdir in os.scandir(self.dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if not entry.name.endswith(".npy"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:   # removed by another process
+                    continue
+                frames.append((entry.path, stat.st_mtime, stat.st_size))
+        return frames
+
+    def has(self, key):
+        return os.path.exists(self.get_path(key))
+
+    def get(self, key):
+        """ The frame with this fingerprint, or None if it isn't in the cache """
+        path = self.get_path(key)
+        try:
+            frame = np.load(path)
+            os.utime(path)      # it's the most recently used now
+        except (OSError, ValueError):
+            return None
+        return frame
+
+    def put(self, key, frame):
+        path = self.get_path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.partial"
+        try:
+            with open(temp_path, "wb") as fout:
+                np.save(fout, frame)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning(f"Couldn't add a frame to the frame cache: {e}")
+            return
+        self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ Removes the least recently used frames until the cache is well under
+            its size limit """
+        frames = sorted(self.list_frames(), key=lambda frame: frame[1])
+        self.size = sum(size for _, _, size in frames)
+        target = self.max_bytes * EVICTION_TARGET
+        for path, _, size in frames:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+def get_frame_cache(config):
+    """ The frame cache in the config, if there is one """
+    cache_dir = config.get("frame-cache", "")
+    if not cache_dir:
+        return None
+    max_bytes = float(config.get("frame-cache-size", DEFAULT_CACHE_SIZE_MB)) * 1024 * 1024
+    return FrameCache(cache_dir, max_bytes)
@@ -0,0 +1,75 @@
+#################
+#
+# Keeping a render under a memory budget.
+#
+# Most of the memory in a render with several processes is frames: the
+# ranges of frames the workers have rendered and sent back, waiting for
+# the encoder to get to them.  So given a budget, we hand out smaller
+# ranges, and don't hand out another until there's room for it.
+#
+# How much memory is in use is measured (as the resident memory of this
+# process and its children, from /proc) where we can; elsewhere it's
+# estimated from how many frames are in flight.
+#
+#################
+
+import os
+import multiprocessing
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def get_rss(pid):
+    """ The resident memory of a process, in bytes, or None if we can't tell.
+        Where we can, pages shared with other processes (e.g. forked workers
+        and the process that started them) only count their share (PSS), so
+        adding up the processes doesn't count them several times. """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as fin:
+            for line in fin:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        with open(f"/proc/{pid}/statm", "r") as fin:
+            return int(fin.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryBudget:
+    """ A limit on the memory used by this process and its children, in bytes """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.baseline = self.get_used() or 0     # what was in use before we started
+
+    def get_used(self):
+        """ The resident memory of this process and its children, or None if
+            we can't tell """
+        pids = [ os.getpid() ] + [ child.pid for child in multiprocessing.active_children() ]
+        sizes = [ get_rss(pid) for pid in pids ]
+        if any(size is None for size in sizes):
+            return None
+        return sum(sizes)
+
+    def get_frames(self, frame_bytes, reserved_bytes=0):
+        """ How many frames fit in what's left of the budget, keeping reserved_bytes
+            aside for something else """
+        free_bytes = self.budget_bytes - (self.get_used() or self.baseline) - reserved_bytes
+        return max(0, int(free_bytes // frame_bytes))
+
+    def has_room(self, num_bytes, in_flight_bytes=0):
+        """ Whether num_bytes more would still be within the budget, given what's
+            in use, or (if that's more, e.g. because frames being rendered don't
+            show up yet) what was in use at the start plus in_flight_bytes """
+        estimate = self.baseline + in_flight_bytes
+        used = self.get_used()
+        return max(used or 0, estimate) + num_bytes <= self.budget_bytes
+
+
+def get_memory_budget(budget_mb):
+    """ A MemoryBudget of so many megabytes, or None if budget_mb is 0 """
+    if not budget_mb:
+        return None
+    return MemoryBudget(budget_mb * 1024 * 1024)
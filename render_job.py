@@ -0,0 +1,225 @@
+#################
+#
+# Rendering jobs that can pick up where they left off.
+#
+# A long render is written in parts (chunks of frames, or whole slides), each
+# to its own file with a name that only depends on what's in it, in a job
+# directory named after a hash of everything that goes into the render.  A
+# manifest in the directory lists the parts that are finished, so if the
+# render crashes or is killed, running it again with the same inputs finds
+# the same directory and only renders the parts that aren't in the manifest.
+#
+# Parts are written to a temporary name and only renamed once they're
+# complete, so a part that was being written when the render stopped is
+# never mistaken for a finished one.
+#
+# Everything else a render writes along the way (lists of parts for ffmpeg,
+# crossfades, debugging output) goes in the job directory too, rather than
+# in a shared temp/ folder, so any number of renders can run at once on the
+# same machine, from the same directory.  A job is locked while it's being
+# rendered, so two renders of the same inputs don't write over each other's
+# parts.  The root the job directories go in can be anywhere, e.g. on a
+# tmpfs (a RAM disk), and the scratch files are removed when the render
+# ends, however it ends.
+#
+#################
+
+import os
+import json
+import signal
+import shutil
+import hashlib
+import logging
+import threading
+import weakref
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
+
+JOBS_DIR = "temp/jobs"
+TMPFS_DIR = "/dev/shm"
+MANIFEST_FILENAME = "manifest.json"
+LOCK_FILENAME = "lock"
+SCRATCH_DIRNAME = "scratch"
+HASH_BLOCK_SIZE = 1 << 20
+
+# the jobs open in this process, which processes forked from it (e.g. to
+# render frames in parallel) have to let go of
+OPEN_JOBS = weakref.WeakSet()
+
+def hash_inputs(files=(), data=(), settings=None):
+    """ A hash of the contents of the given files, the given bytes, and the
+        given settings (anything that can go into JSON) """
+    hasher = hashlib.sha256()
+    for path in files:
+        if not path:    # optional files that weren't given
+            hasher.update(b"\0")
+            continue
+        with open(path, "rb") as fin:
+            for block in iter(lambda: fin.read(HASH_BLOCK_SIZE), b""):
+                hasher.update(block)
+        hasher.update(b"\0")
+    for item in data:
+        hasher.update(item)
+        hasher.update(b"\0")
+    hasher.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def get_jobs_dir(work_dir=""):
+    """ Where to put job directories: work_dir, or temp/jobs if it's not given,
+        or somewhere on a tmpfs if it's "tmpfs" """
+    if not work_dir:
+        return JOBS_DIR
+    if work_dir == "tmpfs":
+        if os.path.isdir(TMPFS_DIR):
+            return os.path.join(TMPFS_DIR, "readalong-video-jobs")
+        logging.warning(f"There's no tmpfs at {TMPFS_DIR}, using {JOBS_DIR} instead")
+        return JOBS_DIR
+    return work_dir
+
+def lock_file(fd):
+    """ Locks an open file for this process, or raises OSError if another 
+        process has it locked """
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+
+def leave_jobs():
+    """ Runs in a newly forked process: lets go of the jobs it was forked with, 
+        so it doesn't keep them locked after the process that opened them is 
+        done with them, and goes back to dying straight away on SIGTERM, rather 
+        than trying to clean up jobs that aren't its own """
+    for job in list(OPEN_JOBS):
+        if job.previous_sigterm is not None:
+            signal.signal(signal.SIGTERM, job.previous_sigterm)
+            job.previous_sigterm = None
+        if job.lock_fd is not None:
+            os.close(job.lock_fd)
+            job.lock_fd = None
+    OPEN_JOBS.clear()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=leave_jobs)
+
+
+class RenderJob:
+    """ The finished parts of a render, in a directory under jobs_dir, with a
+        manifest of which parts are done, and a scratch directory for anything 
+        else the render needs to write.
+
+        Use it in a with statement: if the render finishes, the whole directory
+        is removed; if not, the scratch directory is, but the finished parts
+        are kept for next time. """
+
+    def __init__(self, input_hash, jobs_dir=JOBS_DIR):
+        self.input_hash = input_hash
+        self.dir = os.path.join(jobs_dir, input_hash[:16])
+        self.manifest_path = os.path.join(self.dir, MANIFEST_FILENAME)
+        self.scratch_dir = os.path.join(self.dir, SCRATCH_DIRNAME)
+        self.parts = {}     # name: info about the finished part
+        self.previous_sigterm = None
+
+        os.makedirs(self.dir, exist_ok=True)
+        self.lock_fd = os.open(os.path.join(self.dir, LOCK_FILENAME), 
+                                os.O_RDWR | os.O_CREAT | getattr(os, "O_CLOEXEC", 0))
+        try:
+            lock_file(self.lock_fd)
+        except OSError:
+            os.close(self.lock_fd)
+            raise Exception(f"Another render of the same inputs is already running in {self.dir}")
+        OPEN_JOBS.add(self)
+
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as fin:
+                    manifest = json.load(fin)
+                if manifest.get("input-hash") == input_hash:
+                    self.parts = manifest.get("parts", {})
+            except (OSError, ValueError):
+                logging.warning(f"Couldn't read {self.manifest_path}, starting over")
+        if self.parts:
+            logging.info(f"Resuming job in {self.dir}, {len(self.parts)} parts already done")
+        self.clean_up()     # anything left over from a render that was killed
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        self.save()
+
+    def __enter__(self):
+        # a render that's stopped with SIGTERM (e.g. by a job scheduler) still
+        # gets to clean up after itself
+        if threading.current_thread() is threading.main_thread():
+            self.previous_sigterm = signal.signal(signal.SIGTERM, self.on_sigterm)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.previous_sigterm is not None:
+            signal.signal(signal.SIGTERM, self.previous_sigterm)
+            self.previous_sigterm = None
+        if exc_type is None:
+            self.finish()
+        else:
+            self.close()
+        return False
+
+    def on_sigterm(self, signum, frame):
+        raise SystemExit(128 + signum)
+
+    def get_path(self, name):
+        """ Where the finished part goes """
+        return os.path.join(self.dir, name)
+
+    def get_partial_path(self, name):
+        """ Where to write the part while it isn't finished yet """
+        return os.path.join(self.dir, "partial." + name)
+
+    def get_scratch_path(self, name):
+        """ Where to write a file that's only needed while rendering """
+        return os.path.join(self.scratch_dir, name)
+
+    def is_done(self, name):
+        return name in self.parts and os.path.exists(self.get_path(name))
+
+    def get_info(self, name):
+        return self.parts[name]
+
+    def mark_done(self, name, **info):
+        """ Moves the part from its partial path to its finished path, and
+            records it (and anything about it in info) in the manifest """
+        os.replace(self.get_partial_path(name), self.get_path(name))
+        self.parts[name] = info
+        self.save()
+
+    def save(self):
+        temp_path = self.manifest_path + ".partial"
+        with open(temp_path, "w", encoding="utf-8") as fout:
+            json.dump({ "input-hash": self.input_hash, "parts": self.parts }, fout, indent=2)
+        os.replace(temp_path, self.manifest_path)
+
+    def clean_up(self):
+        """ Removes the scratch directory and any unfinished parts """
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        for entry in os.scandir(self.dir):
+            if entry.name.startswith("partial."):
+                os.remove(entry.path)
+
+    def close(self):
+        """ Cleans up and lets go of the job, keeping the finished parts so the 
+            render can pick up from them next time """
+        if self.lock_fd is None:
+            return
+        self.clean_up()
+        os.close(self.lock_fd)
+        self.lock_fd = None
+        OPEN_JOBS.discard(self)
+
+    def finish(self):
+        """ Removes the job directory, once the parts are all put together """
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+            OPEN_JOBS.discard(self)
+        shutil.rmtree(self.dir, ignore_errors=True)
@@ -0,0 +1,252 @@
+#################
+#
+# A renderer just for ReadAlong slides (as laid out by tei_to_svg), that skips
+# general SVG rasterization.
+#
+# A slide is nothing but text tokens in fixed places, which change color and
+# get squished and skewed, and one ball that bounces along arcs.  So each
+# token's text, and the ball, are rasterized once, as sprites, and each frame
+# just puts the sprites where they go: pasted as they are for tokens that are
+# only colored, warped for tokens (and the ball) that are squished or turned.
+#
+# The tokens come from the Slide in the Slideshow model, which knows their
+# text, font and colors; where they are, and what color, at a given time comes
+# from the slide's SVG animation (through SnapshotSVG), so that the timing and
+# easing of the animations is the same as when rendering the SVG.
+#
+# As in FrameRenderer, frames are rendered a window at a time: tokens that
+# don't change during the window are composited onto the background once, and
+# only the ones that do (and the ball) are drawn each frame, on top.
+#
+#################
+
+import numpy as np
+from lxml import etree as et
+from PIL import Image
+from reportlab.lib.colors import toColor
+
+from svg_snapshot import SnapshotSVG
+from svg_layers import get_localname
+from svg_rasterizers import PilRasterizer, get_rasterizer, get_matrix, multiply, \
+                            get_warp_bounds, warp_image, IDENTITY
+from svg_to_mp4 import get_background, blend, get_padded_frame_range, LAYER_WINDOW_DURATION
+
+BALL_ID = "rasv_ball"
+
+# the ball is drawn at this many times its size, so that it stays sharp when
+# it's warped back down
+BALL_SPRITE_SCALE = 2
+
+# how far out from its origin to look for the ball's drawing, in multiples
+# of its radius (or of 64 pixels, whichever is bigger)
+BALL_SPRITE_EXTENT = 4
+
+def get_slide_tokens(slide):
+    """ The tokens of a slide, in the order their <text> elements are in its SVG """
+    return [ token for sentence in slide.children
+                   for line in sentence.children
+                   for token in line.children ]
+
+
+class Sprite:
+    """ An image drawn once, as premultiplied colors and alpha, with its origin
+        (the point that goes where the element's transform puts (0, 0)) at
+        origin in it """
+
+    def __init__(self, rgb, alpha, origin):
+        self.rgb = rgb
+        self.alpha = alpha
+        self.origin = origin
+        self.rgb_image = Image.fromarray(rgb)
+        self.alpha_image = Image.fromarray(alpha)
+
+
+class SpriteRenderer:
+    """ Renders the frames of one slide, from the Slide (of a laid-out Slideshow)
+        and its animated SVG (from Slideshow.asSVG) """
+
+    def __init__(self, slide, svg_tree, config, fps):
+        self.snapshot_svg = SnapshotSVG(svg_tree)
+        self.fps = fps
+        self.pil_rasterizer = PilRasterizer()   # for its text masks and fonts
+        self.matrices = {}  # transform attribute: matrix
+
+        # the layout is in the SVG's own units, drawn scale times bigger (or smaller)
+        self.scale = float(config.get("scale", 1))
+        self.view = (self.scale, 0.0, 0.0, self.scale, 0.0, 0.0)
+        self.unscale = (1 / self.scale, 0.0, 0.0, 1 / self.scale, 0.0, 0.0)
+
+        svg = self.snapshot_svg.svg
+        self.base = get_background(config)
+        if self.base is None:
+            height, width = self.pil_rasterizer.get_canvas_size(svg)
+            height, width = round(height * self.scale), round(width * self.scale)
+            bg_rgb = toColor(config.get("bg-color", "rgb(0,0,0)")).bitmap_rgb()
+            self.base = np.full((height, width, 3), bg_rgb, dtype="uint8")
+
+        # pair each token up with its <text> element
+        tokens = get_slide_tokens(slide)
+        self.text_elems = [ elem for elem in svg.iter(et.Element) if get_localname(elem) == "text" ]
+        if len(tokens) != len(self.text_elems):
+            raise Exception(f"Slide has {len(tokens)} tokens, but its SVG has "
+                            f"{len(self.text_elems)} text elements")
+
+        # each token's text as a coverage mask, colored as needed
+        self.masks = []     # (coverage, origin), or None for blank tokens
+        for token in tokens:
+            text = " ".join(token.text.split())
+            if not text:
+                self.masks.append(None)
+                continue
+            font_name = self.pil_rasterizer.converter.convertFontFamily(token.getFont())
+            mask, origin = self.pil_rasterizer.get_text_mask(text, font_name, 
+                                                    token.getFontSize() * self.scale, "ls")
+            self.masks.append((mask, origin))
+        self.colored = {}   # (token index, rgb): Sprite
+
+        self.ball_elem = next((elem for elem in svg.iter(et.Element)
+                                if elem.attrib.get("id") == BALL_ID), None)
+        self.ball_sprite = None
+        if self.ball_elem is not None:
+            self.ball_sprite = self.draw_ball(config)
+        self.static_cache = {}  # composited static tokens in the previous window
+
+    def draw_ball(self, config):
+        """ Rasterizes the ball (whatever's inside its group) once, at its own
+            origin, with the rasterizer from the config """
+        radius = float(config.get("ball-radius", 12))
+        extent = BALL_SPRITE_EXTENT * max(radius, 64) * BALL_SPRITE_SCALE
+        doc = et.Element("svg", width=str(2 * extent), height=str(2 * extent))
+        group = et.SubElement(doc, "g", transform=f"translate({extent} {extent}) "
+                                                   f"scale({BALL_SPRITE_SCALE})")
+        for child in self.ball_elem:
+            if isinstance(child.tag, str) and not get_localname(child).startswith(("animate", "set")):
+                group.append(et.fromstring(et.tostring(child)))
+        raster = get_rasterizer(config).render_layer(doc)
+        if raster is None:
+            return None
+        top, left, rgb, alpha = raster
+        return Sprite(np.ascontiguousarray(rgb), np.ascontiguousarray(alpha),
+                      (extent - left, extent - top))
+
+    def get_matrix(self, elem):
+        """ The current transform of an element, from its own coordinates to the canvas """
+        matrix = IDENTITY
+        for ancestor in reversed([ elem ] + list(elem.iterancestors())):
+            transform = ancestor.attrib.get("transform", "")
+            if not transform:
+                continue
+            if transform not in self.matrices:
+                transform_matrix = IDENTITY
+                for operation, values in self.pil_rasterizer.converter.convertTransform(transform):
+                    transform_matrix = multiply(transform_matrix, get_matrix(operation, values))
+                self.matrices[transform] = transform_matrix
+            matrix = multiply(matrix, self.matrices[transform])
+        return matrix
+
+    def get_token_states(self):
+        """ The current (matrix, rgb) of each token; the matrix is for its sprite,
+            which is already drawn at the scale """
+        states = []
+        for elem in self.text_elems:
+            color = toColor(elem.attrib.get("fill", "black"))
+            rgb = tuple(round(v * 255) for v in (color.red, color.green, color.blue))
+            x, y = float(elem.attrib.get("x", 0)), float(elem.attrib.get("y", 0))
+            matrix = multiply(self.get_matrix(elem), (1.0, 0.0, 0.0, 1.0, x, y))
+            states.append((multiply(self.view, multiply(matrix, self.unscale)), rgb))
+        return states
+
+    def get_colored(self, idx, rgb):
+        """ Token idx's sprite, in the given color """
+        key = (idx, rgb)
+        if key not in self.colored:
+            mask, origin = self.masks[idx]
+            alpha = np.asarray(mask)
+            colors = (alpha[:,:,np.newaxis] * np.array(rgb, dtype=np.float32) / 255)
+            self.colored[key] = Sprite(colors.round().astype("uint8"), alpha, origin)
+        return self.colored[key]
+
+    def draw_sprite(self, frame, sprite, matrix):
+        """ Composites a sprite onto the frame, in place, transformed by matrix """
+        a, b, c, d, e, f = matrix
+        ox, oy = sprite.origin
+        moved_only = abs(a - 1) < 1e-6 and abs(d - 1) < 1e-6 and abs(b) < 1e-6 and abs(c) < 1e-6
+        if moved_only:
+            # paste it as it is, to the nearest pixel
+            x1, y1 = round(e - ox), round(f - oy)
+            bounds = (x1, y1, x1 + sprite.alpha.shape[1], y1 + sprite.alpha.shape[0])
+        else:
+            to_canvas = multiply(matrix, (1.0, 0.0, 0.0, 1.0, -ox, -oy))
+            bounds = get_warp_bounds(sprite.alpha_image.size, to_canvas)
+            if bounds is None:
+                return
+
+        # clip to the frame
+        x1, y1, x2, y2 = bounds
+        height, width = frame.shape[:2]
+        cx1, cy1 = max(x1, 0), max(y1, 0)
+        cx2, cy2 = min(x2, width), min(y2, height)
+        if cx2 <= cx1 or cy2 <= cy1:
+            return
+        if moved_only:
+            rgb, alpha = sprite.rgb, sprite.alpha
+        else:
+            rgb = np.asarray(warp_image(sprite.rgb_image, to_canvas, bounds))
+            alpha = np.asarray(warp_image(sprite.alpha_image, to_canvas, bounds))
+        blend(frame[cy1:cy2, cx1:cx2],
+              rgb[cy1 - y1:cy2 - y1, cx1 - x1:cx2 - x1],
+              alpha[cy1 - y1:cy2 - y1, cx1 - x1:cx2 - x1])
+
+    def draw_token(self, frame, idx, state):
+        if self.masks[idx] is None:
+            return
+        matrix, rgb = state
+        self.draw_sprite(frame, self.get_colored(idx, rgb), matrix)
+
+    def render(self, first_frame, last_frame):
+        """ Renders the frames from first_frame up to (but not including) last_frame """
+        window_frames = max(1, round(LAYER_WINDOW_DURATION * self.fps))
+        for window_begin in range(first_frame, last_frame, window_frames):
+            window_end = min(last_frame, window_begin + window_frames)
+            yield from self.render_window(window_begin, window_end)
+
+    def render_window(self, first_frame, last_frame):
+        snapshot_svg = self.snapshot_svg
+
+        # step through the window first, to find out which tokens change during it
+        token_states, ball_matrices, changed = [], [], []
+        for _ in snapshot_svg.frame_range(first_frame, last_frame, self.fps):
+            token_states.append(self.get_token_states())
+            ball_matrices.append(self.get_matrix(self.ball_elem) if self.ball_sprite else None)
+            changed.append(snapshot_svg.has_changed())
+        animated = [ idx for idx in range(len(self.text_elems))
+                        if any(states[idx] != token_states[0][idx] for states in token_states) ]
+
+        # the rest go onto the background once
+        static_key = tuple((idx, state) for idx, state in enumerate(token_states[0])
+                            if idx not in animated)
+        if static_key in self.static_cache:
+            base = self.static_cache[static_key]
+        else:
+            base = self.base.copy()
+            for idx, state in static_key:
+                self.draw_token(base, idx, state)
+        self.static_cache = { static_key: base }
+
+        frame = None
+        for states, ball_matrix, frame_changed in zip(token_states, ball_matrices, changed):
+            if frame is None or frame_changed:
+                frame = base.copy()
+                for idx in animated:
+                    self.draw_token(frame, idx, states[idx])
+                if self.ball_sprite is not None:
+                    ball_matrix = multiply(ball_matrix, (1 / BALL_SPRITE_SCALE, 0.0, 0.0,
+                                                         1 / BALL_SPRITE_SCALE, 0.0, 0.0))
+                    self.draw_sprite(frame, self.ball_sprite, multiply(self.view, ball_matrix))
+            yield frame
+
+
+def sprite_frames(slide, svg_tree, config, fps, begin_time=0.0, end_time=3.0, padding_duration=0.0):
+    """ Like svg_frames, but renders a ReadAlong slide with a SpriteRenderer """
+    first_frame, last_frame = get_padded_frame_range(begin_time, end_time, padding_duration, fps)
+    yield from SpriteRenderer(slide, svg_tree, config, fps).render(first_frame, last_frame)
@@ -0,0 +1,102 @@
+#################
+#
+# Splits a snapshot of an SVG animation into layers, so that the parts of
+# it that don't change over a stretch of time can be rendered once and reused,
+# and only the parts that do change have to be rendered every frame.
+#
+# Layers follow the painting order of the document: a layer is a run of
+# consecutive elements that are all static or all animated, so stacking the
+# layers in order paints everything in the same order the whole document
+# would have.  Groups that contain both static and animated elements are
+# split into their children (with each layer keeping its own copy of the
+# group, so inherited attributes and transforms still apply); anything else
+# that contains an animated element is animated as a whole.
+#
+#################
+
+from copy import deepcopy
+from lxml import etree as et
+
+CONTAINER_TAGS = [ "svg", "g", "a", "switch" ]
+NON_PAINTING_TAGS = [ "defs", "style", "title", "desc", "metadata", "script" ]  # kept in every layer
+
+def get_localname(elem):
+    return et.QName(elem).localname
+
+def get_paint_units(svg, animated_elems):
+    """ Splits the document into the units it's painted in, in order, as
+        (path, is_animated) pairs, where path is a tuple of child indices
+        from the root """
+
+    touched = set()     # animated elements and their ancestors
+    for elem in animated_elems:
+        while elem is not None and elem not in touched:
+            touched.add(elem)
+            elem = elem.getparent()
+
+    animated_elems = set(animated_elems)
+    units = []
+
+    def add_units(elem, path):
+        for idx, child in enumerate(elem):
+            if not isinstance(child.tag, str) or get_localname(child) in NON_PAINTING_TAGS:
+                continue
+            child_path = path + (idx,)
+            if child not in touched:
+                units.append((child_path, False))
+            elif child in animated_elems or get_localname(child) not in CONTAINER_TAGS:
+                units.append((child_path, True))
+            else:
+                add_units(child, child_path)
+
+    add_units(svg, ())
+    return units
+
+def get_layer_runs(units):
+    """ Groups consecutive paint units that are both static or both animated,
+        giving a list of (is_animated, paths) pairs from bottom to top """
+    runs = []
+    for path, is_animated in units:
+        if runs and runs[-1][0] == is_animated:
+            runs[-1][1].append(path)
+        else:
+            runs.append((is_animated, [path]))
+    return runs
+
+def get_by_path(svg, path):
+    elem = svg
+    for idx in path:
+        elem = elem[idx]
+    return elem
+
+
+class Layer:
+    """ A copy of the document with only the paint units in paths, and with
+        the elements whose ids are in target_ids ready to be updated """
+
+    def __init__(self, svg, paths, all_paths, target_ids=()):
+        self.svg = deepcopy(svg)
+        keep = set(paths)
+        removing = [ get_by_path(self.svg, path) for path in all_paths if path not in keep ]
+        for elem in removing:
+            elem.getparent().remove(elem)
+
+        target_ids = set(target_ids)
+        self.targets = { elem.attrib["id"]: elem for elem in self.svg.iter(et.Element)
+                            if elem.attrib.get("id") in target_ids }
+        self.states = { target_id: dict(elem.attrib) for target_id, elem in self.targets.items() }
+
+    def set_states(self, states, baselines):
+        """ Sets the attributes of the animated elements in this layer, given the
+            states and baseline attributes from a SnapshotSVG, and returns the ids 
+            of the ones that changed """
+        changed = []
+        for target_id, elem in self.targets.items():
+            attrib = states.get(target_id, baselines[target_id])
+            if attrib == self.states[target_id]:
+                continue
+            elem.attrib.clear()
+            elem.attrib.update(attrib)
+            self.states[target_id] = attrib
+            changed.append(target_id)
+        return changed
@@ -0,0 +1,653 @@
+#################
+#
+# Rasterizers turn static SVG documents (snapshots of an animation, or layers
+# of one) into images.  Each rasterizer renders a document cropped to the
+# bounds of what's drawn in it, as a "raster": (top, left, rgb, alpha), with
+# the colors premultiplied by alpha, so that FrameRenderer can composite
+# layers from any of them the same way.
+#
+# ReportlabRasterizer converts the document with svglib and renders it with
+# reportlab's renderPM.  It handles everything svglib does, but it's slow,
+# and renderPM can't render transparency (so it renders twice, see below).
+#
+# PilRasterizer draws the document directly with PIL.  It only handles what
+# tei_to_svg actually emits -- text, basic shapes, paths, groups, affine
+# transforms, and fill/stroke colors and opacity -- and skips anything else
+# with a warning.  It reads attributes the same way svglib does (through
+# svglib's own attribute converter), so the two mostly look alike, except
+# for edges a fraction of a pixel apart and a few places where svglib and
+# renderPM depart from SVG (opacity, visibility, and stroke widths under
+# transforms), which PilRasterizer follows SVG on.  The benchmark_rasterizers.py
+# script compares them on a given SVG, for speed and for how different their
+# frames look.
+#
+#################
+
+from collections import OrderedDict
+import logging
+import math
+
+import numpy as np
+from lxml import etree as et
+from PIL import Image, ImageDraw, ImageFont
+from svglib.svglib import SvgRenderer, Svg2RlgAttributeConverter
+from svg.path import parse_path, Move, Line, Close
+from reportlab.graphics import renderPM
+from reportlab.graphics.shapes import Drawing, Group
+from reportlab.lib.colors import toColor
+from reportlab.pdfbase import pdfmetrics
+
+# svglib resolves relative references (e.g. to images) relative to the
+# location of the SVG file; we render from memory, but as if from here
+SVG_SOURCE_PATH = "temp/temp.svg"
+
+# layers are rendered cropped to the bounds of what's in them, plus this
+# many pixels, since text bounds are approximate and edges are antialiased
+LAYER_MARGIN = 8
+
+def get_mask(rgb, transparent_rgb):
+    """ Marks the pixels that aren't the transparent background color """
+    r, g, b = transparent_rgb
+    return (rgb[:,:,0] != r) | (rgb[:,:,1] != g) | (rgb[:,:,2] != b)
+
+def get_alpha(over_black, over_white):
+    """ Recovers premultiplied colors and alpha from two renders of the same
+        thing, one over black and one over white.  Over white, each pixel is
+        lighter by however much of the background shows through it. """
+    difference = over_white.astype(np.int16) - over_black
+    alpha = (255 - difference.mean(axis=2)).round().clip(0, 255).astype("uint8")
+    return np.minimum(over_black, alpha[:,:,np.newaxis]), alpha
+
+
+class AnimatedLayer:
+    """ A Layer (from svg_layers) that's rendered again every frame.  By default
+        this just renders the whole layer each time. """
+
+    def __init__(self, rasterizer, layer):
+        self.rasterizer = rasterizer
+        self.layer = layer
+
+    def render(self, states, baselines):
+        """ Renders the layer in the given states (from a SnapshotSVG) """
+        self.layer.set_states(states, baselines)
+        return self.rasterizer.render_layer(self.layer.svg)
+
+
+class Rasterizer:
+    """ Base class for rasterizers """
+
+    name = ""
+
+    def render_layer(self, svg):
+        """ Renders an SVG document, cropped to the bounds of what's drawn in it.
+            Returns (top, left, rgb, alpha), with the colors premultiplied by alpha,
+            or None if nothing is drawn. """
+        raise NotImplementedError
+
+    def get_canvas_size(self, svg):
+        """ The (height, width) in pixels that an SVG document renders at """
+        raise NotImplementedError
+
+    def animate_layer(self, layer):
+        """ Wraps a Layer to be rendered again every frame """
+        return AnimatedLayer(self, layer)
+
+    def render_frame(self, svg):
+        """ Renders a whole SVG document as an (uncropped, not premultiplied)
+            RGBA array """
+        height, width = self.get_canvas_size(svg)
+        frame = np.zeros((height, width, 4), dtype="uint8")
+        raster = self.render_layer(svg)
+        if raster is None:
+            return frame
+        top, left, rgb, alpha = raster
+        region = frame[top:top + rgb.shape[0], left:left + rgb.shape[1]]
+        height, width = region.shape[:2]
+        alpha = alpha[:height,:width]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            unpremultiplied = rgb[:height,:width] * 255.0 / alpha[:,:,np.newaxis]
+        region[:,:,:3] = np.nan_to_num(unpremultiplied).round().clip(0, 255)
+        region[:,:,3] = alpha
+        return frame
+
+
+#################
+#
+# reportlab
+#
+#################
+
+class TrackingSvgRenderer(SvgRenderer):
+    """ An svglib renderer that puts what each element with one of target_ids
+        becomes into a Group of its own, so that later the element can be converted
+        again by itself and swapped in, without converting the whole document """
+
+    def __init__(self, path, target_ids):
+        super().__init__(path)
+        self.target_ids = target_ids
+        self.groups = {}    # target_id: Group
+
+    def renderNode(self, node, parent=None):
+        target_id = node.get("id")
+        if parent is None or target_id not in self.target_ids:
+            return super().renderNode(node, parent)
+        group = Group()
+        super().renderNode(node, group)
+        parent.add(group)
+        self.groups[target_id] = group
+
+    def update(self, node):
+        """ Converts an element again, replacing what it was before """
+        replacement = Group()
+        super().renderNode(node, replacement)
+        self.groups[node.get("id")].contents = replacement.contents
+
+
+class LayerDrawing(AnimatedLayer):
+    """ A reportlab Drawing of a Layer that's kept from frame to frame,
+        converting only the elements that change """
+
+    def __init__(self, rasterizer, layer):
+        super().__init__(rasterizer, layer)
+        self.renderer = TrackingSvgRenderer(SVG_SOURCE_PATH, set(layer.targets))
+        self.drawing = self.renderer.render(layer.svg)
+
+    def update(self, states, baselines):
+        """ Updates the drawing to the given states (from a SnapshotSVG) """
+        changed = self.layer.set_states(states, baselines)
+        if any(target_id not in self.renderer.groups for target_id in changed):
+            # not something we can swap out by itself (e.g. the root element)
+            self.renderer = TrackingSvgRenderer(SVG_SOURCE_PATH, set(self.layer.targets))
+            self.drawing = self.renderer.render(self.layer.svg)
+            return self.drawing
+        for target_id in changed:
+            self.renderer.update(self.layer.targets[target_id])
+        return self.drawing
+
+    def render(self, states, baselines):
+        return render_drawing(self.update(states, baselines), self.rasterizer.key_rgb)
+
+
+def render_drawing(drawing, key_rgb=None):
+    """ Rasterizes a reportlab Drawing, as in ReportlabRasterizer.render_layer """
+
+    bounds = drawing.getBounds()
+    if bounds is None:
+        return None
+
+    # reportlab's y axis goes up from the bottom of the drawing
+    x1, y1, x2, y2 = bounds
+    width, height = int(drawing.width), int(drawing.height)
+    left = max(0, math.floor(x1) - LAYER_MARGIN)
+    right = min(width, math.ceil(x2) + LAYER_MARGIN)
+    bottom = max(0, math.floor(y1) - LAYER_MARGIN)
+    top = min(height, math.ceil(y2) + LAYER_MARGIN)
+    if right <= left or top <= bottom:
+        return None
+
+    cropped = Drawing(right - left, top - bottom)
+    contents = Group(*drawing.contents)
+    contents.translate(-left, -bottom)
+    cropped.add(contents)
+
+    if key_rgb is not None:
+        r, g, b = key_rgb
+        rgb = np.asarray(renderPM.drawToPIL(cropped, bg=b + 2**8 * g + 2**16 * r))
+        mask = get_mask(rgb, key_rgb)
+        rgb = rgb * mask[:,:,np.newaxis]
+        return height - top, left, rgb, mask.astype("uint8") * 255
+
+    over_black = np.asarray(renderPM.drawToPIL(cropped, bg=0x000000))
+    over_white = np.asarray(renderPM.drawToPIL(cropped, bg=0xffffff))
+    return (height - top, left) + get_alpha(over_black, over_white)
+
+
+class ReportlabRasterizer(Rasterizer):
+    """ Renders through svglib and reportlab's renderPM.
+
+        renderPM can't render transparency, so by default this renders twice, over
+        black and over white, and works out alpha from the difference.  Given a
+        key_rgb color instead, it renders once over that color and keys it out,
+        which is faster but leaves no partial transparency. """
+
+    name = "reportlab"
+
+    def __init__(self, key_rgb=None):
+        self.key_rgb = key_rgb
+
+    def render_layer(self, svg):
+        drawing = SvgRenderer(SVG_SOURCE_PATH).render(svg)
+        return render_drawing(drawing, self.key_rgb)
+
+    def get_canvas_size(self, svg):
+        drawing = SvgRenderer(SVG_SOURCE_PATH).render(svg)
+        return int(drawing.height), int(drawing.width)
+
+    def animate_layer(self, layer):
+        return LayerDrawing(self, layer)
+
+
+#################
+#
+# PIL
+#
+#################
+
+SUPERSAMPLING = 4       # shapes are drawn at this many times the resolution, for antialiasing
+CURVE_TOLERANCE = 0.5   # how far (in pixels) flattened curves can stray from the real ones
+TEXT_CACHE_SIZE = 1000  # glyph masks kept around, since most text only changes color
+
+SHAPE_TAGS = [ "rect", "circle", "ellipse", "line", "polyline", "polygon", "path" ]
+SKIPPED_TAGS = [ "defs", "style", "title", "desc", "metadata", "script" ]
+INHERITED_ATTRIBS = [ "color", "fill", "fill-opacity", "fill-rule", "stroke", "stroke-width",
+                      "stroke-opacity", "font-family", "font-size", "text-anchor", "visibility" ]
+DEFAULT_STYLE = { "fill": "black", "font-family": "Helvetica", "font-size": "12" }
+TEXT_ANCHORS = { "start": "ls", "middle": "ms", "end": "rs" }   # to PIL anchors, at the baseline
+
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+def get_localname(elem):
+    return et.QName(elem).localname
+
+def multiply(m1, m2):
+    """ Composes two SVG transform matrices (a, b, c, d, e, f), m2 applying first """
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a1 * a2 + c1 * b2, b1 * a2 + d1 * b2,
+            a1 * c2 + c1 * d2, b1 * c2 + d1 * d2,
+            a1 * e2 + c1 * f2 + e1, b1 * e2 + d1 * f2 + f1)
+
+def get_matrix(operation, values):
+    """ The matrix of one operation from svglib's convertTransform """
+    if not isinstance(values, tuple):
+        values = (values,)
+    if operation == "matrix":
+        return tuple(values)
+    if operation == "translate":
+        tx, ty = values if len(values) == 2 else (values[0], 0.0)
+        return (1.0, 0.0, 0.0, 1.0, tx, ty)
+    if operation == "scale":
+        sx, sy = values if len(values) == 2 else (values[0], values[0])
+        return (sx, 0.0, 0.0, sy, 0.0, 0.0)
+    if operation == "rotate":
+        angle = math.radians(values[0])
+        cos, sin = math.cos(angle), math.sin(angle)
+        rotation = (cos, sin, -sin, cos, 0.0, 0.0)
+        if len(values) == 3:
+            cx, cy = values[1:]
+            rotation = multiply(multiply((1.0, 0.0, 0.0, 1.0, cx, cy), rotation),
+                                (1.0, 0.0, 0.0, 1.0, -cx, -cy))
+        return rotation
+    if operation == "skewX":
+        return (1.0, 0.0, math.tan(math.radians(values[0])), 1.0, 0.0, 0.0)
+    if operation == "skewY":
+        return (1.0, math.tan(math.radians(values[0])), 0.0, 1.0, 0.0, 0.0)
+    logging.warning(f"Unknown transform {operation}")
+    return IDENTITY
+
+def apply_matrix(matrix, points):
+    """ Transforms an (n, 2) array of points """
+    a, b, c, d, e, f = matrix
+    return np.stack([ a * points[:,0] + c * points[:,1] + e,
+                      b * points[:,0] + d * points[:,1] + f ], axis=1)
+
+def get_scale(matrix):
+    """ About how much a matrix scales things, on average """
+    a, b, c, d, _, _ = matrix
+    return math.sqrt(abs(a * d - b * c))
+
+def get_warp_bounds(size, matrix):
+    """ Where an image of the given (width, height) lands when transformed by
+        matrix (from its pixels to the canvas), as (x1, y1, x2, y2), or None if
+        the matrix flattens it """
+    a, b, c, d, _, _ = matrix
+    if abs(a * d - b * c) < 1e-9:
+        return None
+    width, height = size
+    corners = apply_matrix(matrix, np.array([ (0, 0), (width, 0), (0, height), (width, height) ]))
+    x1, y1 = np.floor(corners.min(axis=0)).astype(int)
+    x2, y2 = np.ceil(corners.max(axis=0)).astype(int)
+    return int(x1), int(y1), int(x2), int(y2)
+
+def warp_image(image, matrix, bounds):
+    """ Transforms a PIL image by matrix (from its pixels to the canvas), resampling
+        bilinearly, giving the part of the canvas within bounds (x1, y1, x2, y2) """
+    x1, y1, x2, y2 = bounds
+    a, b, c, d, e, f = matrix
+    det = a * d - b * c
+    # Image.transform wants the inverse, from the canvas back to the image
+    ia, ib, ic, id_ = d / det, -b / det, -c / det, a / det
+    ie, if_ = -(ia * (e - x1) + ic * (f - y1)), -(ib * (e - x1) + id_ * (f - y1))
+    return image.transform((x2 - x1, y2 - y1), Image.AFFINE,
+                            (ia, ic, ie, ib, id_, if_), resample=Image.BILINEAR)
+
+def get_signed_area(points):
+    x, y = points[:,0], points[:,1]
+    return (np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+class PilRasterizer(Rasterizer):
+    """ Draws directly with PIL, for the limited set of features tei_to_svg uses """
+
+    name = "pil"
+
+    def __init__(self):
+        self.converter = Svg2RlgAttributeConverter()
+        self.fonts = {}                     # (font name, size): ImageFont
+        self.text_masks = OrderedDict()     # (text, font name, size, anchor): (mask, origin)
+        self.paths = {}                     # (tag, geometry, detail): [ (points, is_closed) ]
+        self.warned = set()
+
+    def warn(self, message):
+        if message not in self.warned:
+            logging.warning(message)
+            self.warned.add(message)
+
+    def get_canvas_size(self, svg):
+        width = self.converter.convertLength(svg.attrib.get("width", "0"))
+        height = self.converter.convertLength(svg.attrib.get("height", "0"))
+        if (not width or not height) and "viewBox" in svg.attrib:
+            _, _, width, height = [ float(v) for v in svg.attrib["viewBox"].replace(",", " ").split() ]
+        return int(height), int(width)
+
+    def render_layer(self, svg):
+        height, width = self.get_canvas_size(svg)
+        matrix = IDENTITY
+        if "viewBox" in svg.attrib:
+            x, y, w, h = [ float(v) for v in svg.attrib["viewBox"].replace(",", " ").split() ]
+            if w and h:
+                matrix = (width / w, 0.0, 0.0, height / h, -x * width / w, -y * height / h)
+
+        # first work out what gets drawn where, then what part of the canvas that covers
+        items = []
+        self.collect_items(svg, matrix, DEFAULT_STYLE, 1.0, items)
+        items = [ (bounds, color, coverage) for bounds, color, coverage in items
+                    if bounds[0] < width and bounds[1] < height and bounds[2] > 0 and bounds[3] > 0 ]
+        if not items:
+            return None
+        left = max(0, min(bounds[0] for bounds, _, _ in items) - LAYER_MARGIN)
+        top = max(0, min(bounds[1] for bounds, _, _ in items) - LAYER_MARGIN)
+        right = min(width, max(bounds[2] for bounds, _, _ in items) + LAYER_MARGIN)
+        bottom = min(height, max(bounds[3] for bounds, _, _ in items) + LAYER_MARGIN)
+
+        rgb = np.zeros((bottom - top, right - left, 3), dtype=np.float32)
+        alpha = np.zeros((bottom - top, right - left), dtype=np.float32)
+        for (x1, y1, x2, y2), color, get_coverage in items:
+            coverage = get_coverage()   # over (x1, y1, x2, y2), from 0 to 1
+            # clip to the part of the canvas we're drawing
+            cx1, cy1 = max(x1, left), max(y1, top)
+            cx2, cy2 = min(x2, right), min(y2, bottom)
+            if cx2 <= cx1 or cy2 <= cy1:
+                continue
+            coverage = coverage[cy1 - y1:cy2 - y1, cx1 - x1:cx2 - x1] * color[3]
+            region = np.s_[cy1 - top:cy2 - top, cx1 - left:cx2 - left]
+            inverse = 1 - coverage
+            rgb[region] = color[:3] * coverage[:,:,np.newaxis] + rgb[region] * inverse[:,:,np.newaxis]
+            alpha[region] = coverage + alpha[region] * inverse
+
+        rgb = (rgb * 255).round().astype("uint8")
+        alpha = (alpha * 255).round().astype("uint8")
+        return top, left, np.minimum(rgb, alpha[:,:,np.newaxis]), alpha
+
+    def get_style(self, elem, parent_style):
+        """ The inherited style attributes of an element """
+        style = dict(parent_style)
+        attrib = dict(elem.attrib)
+        for declaration in attrib.pop("style", "").split(";"):
+            if ":" in declaration:
+                name, value = declaration.split(":", 1)
+                attrib[name.strip()] = value.strip()
+        for name in INHERITED_ATTRIBS:
+            if name in attrib and attrib[name] != "inherit":
+                style[name] = attrib[name]
+        return style, attrib
+
+    def get_color(self, style, name, opacity):
+        """ The (r, g, b, a) fill or stroke color in a style, from 0 to 1, or None """
+        value = style.get(name, "none")
+        if value == "currentColor":
+            value = style.get("color", "black")
+        color = self.converter.convertColor(value)
+        if color is None or not hasattr(color, "bitmap_rgb"):
+            return None
+        opacity *= float(style.get(name + "-opacity", 1)) * color.alpha
+        if opacity <= 0:
+            return None
+        return np.array([ color.red, color.green, color.blue, opacity ], dtype=np.float32)
+
+    def collect_items(self, elem, matrix, parent_style, opacity, items):
+        """ Works out what an element and its children draw, adding (bounds, color,
+            get_coverage) items in painting order, where get_coverage gives an
+            array of how much of each pixel in bounds (x1, y1, x2, y2) is covered """
+        for child in elem:
+            if not isinstance(child.tag, str):
+                continue
+            tag = get_localname(child)
+            if tag in SKIPPED_TAGS:
+                continue
+            style, attrib = self.get_style(child, parent_style)
+            if attrib.get("display") == "none":
+                continue
+            child_matrix = matrix
+            for operation, values in self.converter.convertTransform(attrib.get("transform", "")):
+                child_matrix = multiply(child_matrix, get_matrix(operation, values))
+            child_opacity = opacity * float(attrib.get("opacity", 1))
+            if child_opacity <= 0:
+                continue
+
+            if tag in [ "g", "a", "switch", "svg" ]:
+                self.collect_items(child, child_matrix, style, child_opacity, items)
+            elif style.get("visibility") in [ "hidden", "collapse" ]:
+                continue
+            elif tag == "text":
+                self.collect_text(child, child_matrix, style, child_opacity, items)
+            elif tag in SHAPE_TAGS:
+                self.collect_shape(child, tag, child_matrix, style, child_opacity, items)
+            else:
+                self.warn(f"The {self.name} rasterizer can't draw <{tag}> elements; skipping them")
+
+    #################
+    # text
+    #################
+
+    def get_font(self, font_name, size):
+        key = (font_name, size)
+        if key not in self.fonts:
+            face = getattr(pdfmetrics.getFont(font_name), "face", None)
+            filename = getattr(face, "filename", None)
+            if filename:
+                self.fonts[key] = ImageFont.truetype(filename, size)
+            else:   # one of reportlab's built-in fonts, which aren't files
+                self.warn(f"No font file for {font_name}, using PIL's default font")
+                self.fonts[key] = ImageFont.load_default(size)
+        return self.fonts[key]
+
+    def get_text_mask(self, text, font_name, size, anchor):
+        """ An "L" image of some text, and where the anchor point is in it """
+        key = (text, font_name, size, anchor)
+        if key in self.text_masks:
+            self.text_masks.move_to_end(key)
+            return self.text_masks[key]
+        font = self.get_font(font_name, size)
+        x1, y1, x2, y2 = font.getbbox(text, anchor=anchor)
+        mask = Image.new("L", (x2 - x1 + 2, y2 - y1 + 2))
+        origin = (1 - x1, 1 - y1)
+        ImageDraw.Draw(mask).text(origin, text, font=font, fill=255, anchor=anchor)
+        self.text_masks[key] = (mask, origin)
+        if len(self.text_masks) > TEXT_CACHE_SIZE:
+            self.text_masks.popitem(last=False)
+        return mask, origin
+
+    def collect_text(self, elem, matrix, style, opacity, items):
+        # like svglib, only fill text (renderPM doesn't stroke it)
+        color = self.get_color(style, "fill", opacity)
+        text = " ".join("".join(elem.itertext()).split())
+        if color is None or not text:
+            return
+        if len(elem):
+            self.warn(f"The {self.name} rasterizer draws <tspan>s as part of their <text>")
+
+        font_name = self.converter.convertFontFamily(style["font-family"])
+        font_size = self.converter.convertLength(style["font-size"])
+        x = self.converter.convertLength(elem.attrib.get("x", "0"), em_base=font_size)
+        y = self.converter.convertLength(elem.attrib.get("y", "0"), em_base=font_size)
+        x, y = (x[0] if isinstance(x, list) else x), (y[0] if isinstance(y, list) else y)
+        anchor = TEXT_ANCHORS.get(style.get("text-anchor", "start"), "ls")
+        matrix = multiply(matrix, (1.0, 0.0, 0.0, 1.0, x, y))
+
+        # draw the text at about the size it'll be on the canvas, then fit it on
+        scale = get_scale(matrix)
+        size = round(font_size * scale, 2)
+        if size <= 0:
+            return
+        mask, (ox, oy) = self.get_text_mask(text, font_name, size, anchor)
+        a, b, c, d, e, f = matrix
+
+        if abs(b) < 1e-6 and abs(c) < 1e-6 and abs(a - d) < 1e-6 and a > 0:
+            # just moved (and scaled uniformly): place it to the nearest pixel
+            x1, y1 = round(e - ox), round(f - oy)
+            bounds = (x1, y1, x1 + mask.width, y1 + mask.height)
+            items.append((bounds, color, lambda: np.asarray(mask, dtype=np.float32) / 255))
+            return
+
+        # from mask pixels to the canvas: scale back down to user units, then the matrix
+        to_canvas = multiply(matrix, (1 / scale, 0.0, 0.0, 1 / scale, -ox / scale, -oy / scale))
+        bounds = get_warp_bounds(mask.size, to_canvas)
+        if bounds is None:
+            return
+        x1, y1, x2, y2 = bounds
+        get_coverage = lambda: np.asarray(warp_image(mask, to_canvas, bounds), dtype=np.float32) / 255
+        items.append(((x1, y1, x2, y2), color, get_coverage))
+
+    #################
+    # shapes
+    #################
+
+    def get_subpaths(self, elem, tag, detail):
+        """ The outline of a shape, as a list of (points, is_closed) in user units,
+            with curves flattened into about detail points per user unit """
+        length = lambda name: self.converter.convertLength(elem.attrib.get(name, "0"))
+        if tag == "path":
+            geometry = elem.attrib.get("d", "")
+        elif tag in [ "polyline", "polygon" ]:
+            geometry = elem.attrib.get("points", "")
+        else:
+            geometry = tuple(length(name) for name in [ "x", "y", "width", "height",
+                                        "cx", "cy", "r", "rx", "ry", "x1", "y1", "x2", "y2" ])
+        key = (tag, geometry, detail)
+        if key in self.paths:
+            return self.paths[key]
+
+        if tag == "path":
+            subpaths = []
+            points = []
+            for segment in parse_path(geometry):
+                if isinstance(segment, Move):
+                    if len(points) > 1:
+                        subpaths.append((np.array(points), False))
+                    points = [ segment.end ]
+                elif isinstance(segment, Close):
+                    points.append(segment.end)
+                    subpaths.append((np.array(points), True))
+                    points = [ segment.end ]
+                elif isinstance(segment, Line):
+                    points.append(segment.end)
+                else:
+                    steps = max(2, min(256, math.ceil(segment.length(error=1e-3) * detail)))
+                    points.extend(segment.point(t) for t in np.linspace(0, 1, steps + 1)[1:])
+            if len(points) > 1:
+                subpaths.append((np.array(points), False))
+            subpaths = [ (np.stack([ p.real, p.imag ], axis=1), closed) for p, closed in subpaths ]
+        elif tag in [ "polyline", "polygon" ]:
+            numbers = [ float(v) for v in geometry.replace(",", " ").split() ]
+            points = np.array(numbers[:len(numbers) // 2 * 2]).reshape(-1, 2)
+            subpaths = [ (points, tag == "polygon") ] if len(points) > 1 else []
+        elif tag == "line":
+            x1, y1, x2, y2 = geometry[-4:]
+            subpaths = [ (np.array([ (x1, y1), (x2, y2) ]), False) ]
+        elif tag == "rect":
+            x, y, width, height = geometry[:4]
+            if elem.attrib.get("rx") or elem.attrib.get("ry"):
+                self.warn(f"The {self.name} rasterizer draws rounded <rect>s with square corners")
+            subpaths = [ (np.array([ (x, y), (x + width, y), (x + width, y + height), (x, y + height) ]), True) ]
+        else:   # circle or ellipse
+            cx, cy, r, rx, ry = geometry[4:9]
+            if tag == "circle":
+                rx = ry = r
+            steps = max(12, min(512, math.ceil(2 * math.pi * max(rx, ry) * detail)))
+            angles = np.linspace(0, 2 * math.pi, steps, endpoint=False)
+            subpaths = [ (np.stack([ cx + rx * np.cos(angles), cy + ry * np.sin(angles) ], axis=1), True) ]
+
+        self.paths[key] = subpaths
+        return subpaths
+
+    def collect_shape(self, elem, tag, matrix, style, opacity, items):
+        fill = self.get_color(style, "fill", opacity) if tag not in [ "line", "polyline" ] else None
+        stroke = self.get_color(style, "stroke", opacity)
+        if fill is None and stroke is None:
+            return
+        # enough points that the flattened curves are within tolerance on the canvas,
+        # rounded to a power of two so that shapes being scaled still hit the cache
+        scale = get_scale(matrix)
+        detail = 2.0 ** math.ceil(math.log2(max(scale, 1e-6) / CURVE_TOLERANCE / 4))
+        subpaths = [ (apply_matrix(matrix, points), closed)
+                        for points, closed in self.get_subpaths(elem, tag, detail) ]
+        if not subpaths:
+            return
+        stroke_width = self.converter.convertLength(style.get("stroke-width", "1")) * scale
+        margin = math.ceil(stroke_width / 2) + 1 if stroke is not None else 1
+        all_points = np.concatenate([ points for points, _ in subpaths ])
+        x1, y1 = np.floor(all_points.min(axis=0)).astype(int) - margin
+        x2, y2 = np.ceil(all_points.max(axis=0)).astype(int) + margin
+        size = ((x2 - x1) * SUPERSAMPLING, (y2 - y1) * SUPERSAMPLING)
+        scaled = [ ([ tuple(p) for p in (points - (x1, y1)) * SUPERSAMPLING ], closed)
+                        for points, closed in subpaths ]
+
+        def downsample(image):
+            pixels = np.asarray(image, dtype=np.float32).reshape(
+                        y2 - y1, SUPERSAMPLING, x2 - x1, SUPERSAMPLING)
+            return pixels.mean(axis=(1, 3))
+
+        def get_fill_coverage():
+            # add up the winding of each subpath, for the fill rule
+            winding = np.zeros((size[1], size[0]), dtype=np.int16)
+            for (points, _), (path_points, _) in zip(scaled, subpaths):
+                if len(points) < 3:
+                    continue
+                image = Image.new("L", size)
+                ImageDraw.Draw(image).polygon(points, fill=1)
+                sign = 1 if get_signed_area(path_points) >= 0 else -1
+                winding += sign * np.asarray(image, dtype=np.int16)
+            if style.get("fill-rule") == "evenodd":
+                inside = (winding % 2) != 0
+            else:
+                inside = winding != 0
+            return downsample(inside)
+
+        def get_stroke_coverage():
+            image = Image.new("L", size)
+            draw = ImageDraw.Draw(image)
+            width = max(1, round(stroke_width * SUPERSAMPLING))
+            for points, closed in scaled:
+                if closed:
+                    points = points + points[:2]
+                draw.line(points, fill=1, width=width, joint="curve")
+            return downsample(image)
+
+        if fill is not None:
+            items.append(((x1, y1, x2, y2), fill, get_fill_coverage))
+        if stroke is not None and stroke_width > 0:
+            items.append(((x1, y1, x2, y2), stroke, get_stroke_coverage))
+
+
+RASTERIZERS = { rasterizer.name: rasterizer for rasterizer in [ ReportlabRasterizer, PilRasterizer ] }
+
+def get_rasterizer(config):
+    """ The rasterizer named in the config ("rasterizer"), reportlab by default """
+    name = config.get("rasterizer", "reportlab")
+    if name not in RASTERIZERS:
+        raise Exception(f"Unknown rasterizer {name}; choose from {', '.join(RASTERIZERS)}")
+    if name == ReportlabRasterizer.name and not config.get("alpha", True):
+        # without alpha, layers are rendered over the background color and keyed out
+        return ReportlabRasterizer(toColor(config.get("bg-color", "rgb(0,0,0)")).bitmap_rgb())
+    return RASTERIZERS[name]()
@@ -27,13 +27,13 @@
 #   way of specifying time are not supported.  Multiple begin/dur
 #   intervals (e.g. begin="0s;2s;4s") are not supported.
 #
-# * It doesn't support calcMode, keySplines, and other attributes
-#   that describe non-linear interpolations.  The only non-linear
-#   interpolations supported are those to get an appropriate interpolation
-#   of the path attribute of animateMotion.  (That is to say, if the
-#   path specifies a cubic curve, we'll calculate that, rather than, say,
-#   do a linear interpolation there.  But if you're animating a color or 
-#   something, the only interpolation supported is linear.)
+# * Animations can be from/to pairs or lists of values (with or without
+#   keyTimes), with calcMode="linear", "discrete", or "spline" (with 
+#   keySplines).  calcMode="paced" is treated as linear, and "by" values 
+#   aren't supported.  animateMotion follows its path as svg.path 
+#   parameterizes it; keyPoints and keyTimes aren't supported there.  (If the
+#   path specifies a cubic curve, we'll calculate that, rather than, say, 
+#   do a linear interpolation there.)
 #
 # * It doesn't support additive animation.  (This is possibly worth
 #   supporting, it wouldn't be too hard, we're just not using it for anything.)
@@ -72,12 +72,18 @@
 
 import math
 import re
+import json
 import logging
+import argparse
+import heapq
+from bisect import bisect_right
+from collections import defaultdict
 from copy import deepcopy
+import numpy as np
 from lxml import etree as et 
 from svg.path import parse_path
 
-from util import parse_time
+from util import parse_time, save_xml
 
 NAMESPACE_PREFIX = '{http://www.w3.org/2000/svg}'
 XLINK_NAMESPACE = '{http://www.w3.org/1999/xlink}'
@@ -111,41 +117,76 @@ def parse_path_str(path_str):
     return PATH_CACHE[path_str]
 
 
-NUMBER_SPLITTER = re.compile(r'([-+]?\d*\.?\d+|[-+]?\d+)')
+MOTION_PATH_RESOLUTION = 256  # samples per motion path; 0 means evaluate the curve every time
+MOTION_PATH_CACHE = {}
+
+class MotionPath:
+    """ A lookup table of the positions and tangent angles along a path, for 
+        animateMotion.  Evaluating the curve itself (and evaluating it twice to
+        get the angle for rotate="auto") every frame is relatively expensive, so
+        we sample it once at evenly-spaced positions and linearly interpolate 
+        between the samples.  The resolution is the number of intervals between 
+        samples; a resolution of 0 means we don't use a table, and evaluate the 
+        curve exactly. """
+
+    def __init__(self, path, resolution=MOTION_PATH_RESOLUTION):
+        self.path = path
+        self.resolution = resolution
+        self.points = []
+        self.angles = []
+        if resolution:
+            positions = [ i / resolution for i in range(resolution + 1) ]
+            self.points = [ path.point(pos) for pos in positions ]
+            self.angles = [ self.get_exact_angle(pos) for pos in positions ]
+
+    def get_exact_angle(self, pos):
+        """ The angle (in degrees) of the direction of travel at position pos """
+        if pos > 0.999:  # don't want nonsense values if we're at the end,
+            current_point = self.path.point(0.999)            # so back up a weee bit
+            next_point = self.path.point(pos)
+        else:
+            current_point = self.path.point(pos)
+            next_point = self.path.point(pos + 0.001)
+        angle = math.atan2(next_point.imag - current_point.imag, next_point.real - current_point.real)
+        return math.degrees(angle)
+
+    def get_sample(self, pos):
+        """ Returns the index of the sample before pos, and how far pos is 
+            between that sample and the next """
+        x = min(max(pos, 0.0), 1.0) * self.resolution
+        i = min(int(x), self.resolution - 1)
+        return i, x - i
+
+    def point(self, pos):
+        if not self.resolution:
+            return self.path.point(pos)
+        i, frac = self.get_sample(pos)
+        return self.points[i] + (self.points[i+1] - self.points[i]) * frac
+
+    def angle(self, pos):
+        if not self.resolution:
+            return self.get_exact_angle(pos)
+        i, frac = self.get_sample(pos)
+        angle1, angle2 = self.angles[i], self.angles[i+1]
+        difference = (angle2 - angle1 + 180.0) % 360.0 - 180.0   # go the short way around
+        return angle1 + difference * frac
+
+
+def get_motion_path(path_str, resolution=MOTION_PATH_RESOLUTION):
+    """ Convenience function for making a MotionPath from a path string; caches
+        because making the lookup table can be expensive """
+
+    key = (path_str, resolution)
+    if key not in MOTION_PATH_CACHE:
+        path = parse_path_str(path_str)
+        if path is None:
+            return None
+        MOTION_PATH_CACHE[key] = MotionPath(path, resolution)
+    return MOTION_PATH_CACHE[key]
 
 
-def interpolate_value_token(s1, s2, pos, mod=0):
-    """ If the values are floats, returns the linear interpolation of them
-        at position pos.  If they're strings, but the same, returns the string.
-        If they're different, raises an exception.
-        
-        The mod argument is for spaces that wrap around, like rotation.  If 
-        we're interpolating two values measured by degrees, we want to
-        interpret both the inputs and the result by modulus 360."""
-
-    v1, v2 = 0.0, 0.0
-    assert(mod >= 0)
-    try:
-        v1 = float(s1)
-        v2 = float(s2)
-        if mod:
-            # note that Python negative mod makes this work; may not work
-            # the same in other languages
-            v1 %= mod
-            v2 %= mod
-            if abs(v1 + mod - v2) < abs(v1 - v2):
-                v1 += mod
-            if abs(v2 + mod - v1) < abs(v2 - v1):
-                v2 += mod
-        interpolation = v1 + pos * (v2 - v1)
-        if mod:
-            interpolation %= mod
-        return "{:.3f}".format(interpolation)
-    except ValueError:
-        if s1 == s2:
-            return s1 
-        else:
-            raise Exception("Cannot interpolate between %s and %s", (s1, s2))
+NUMBER_SPLITTER = re.compile(r'([-+]?\d*\.?\d+|[-+]?\d+)')
+
 
 def isfloat(value):
   try:
@@ -154,6 +195,108 @@ def isfloat(value):
   except ValueError:
     return False
 
+
+class Interpolation:
+    """ A pre-parsed pair of values to interpolate between, like "150 150" and "0 0", 
+        or "rgb(255,255,0)" and "rgb(255,255,100)".
+
+        Parsing the strings (splitting out the numbers, etc.) is relatively expensive
+        and we'd otherwise have to do it every frame, so we parse them once into 
+        arrays of numbers plus a format string holding the text around the numbers 
+        (e.g. "rgb({:.3f},{:.3f},{:.3f})").  The text comes from the first value; 
+        the values must have the same number of numbers.
+
+        For transforms like rotate where one of the values (degrees) wraps around,
+        a modulus argument lets you specify the range (360) for each number; a 
+        modulus of 0 means the number doesn't wrap around.  E.g. rotate might be
+        constructed like so:
+
+        interpolation = Interpolation("0 50 50", "180 50 50", mod=(360,0,0))
+        """
+
+    def __init__(self, s1, s2, mod=None):
+        splits1 = NUMBER_SPLITTER.split(s1)
+        splits2 = NUMBER_SPLITTER.split(s2)
+
+        parts1 = [ float(s) for s in splits1 if isfloat(s) ]
+        parts2 = [ float(s) for s in splits2 if isfloat(s) ]
+    
+        if len(parts1) != len(parts2):
+            raise Exception("Cannot interpolate between %s and %s", (s1, s2))
+
+        self.format_str = "".join("{:.3f}" if isfloat(s) else s.replace("{", "{{").replace("}", "}}")
+                                for s in splits1)
+
+        mod = list(mod or [])[:len(parts1)]
+        mod += [0] * (len(parts1) - len(mod))
+        assert(all(m >= 0 for m in mod))
+        
+        # for modular values, we go whichever way around is shorter; we can 
+        # figure that out now since it doesn't depend on the position
+        for i, m in enumerate(mod):
+            if not m:
+                continue
+            # note that Python negative mod makes this work; may not work
+            # the same in other languages
+            v1 = parts1[i] % m
+            v2 = parts2[i] % m
+            if abs(v1 + m - v2) < abs(v1 - v2):
+                v1 += m
+            if abs(v2 + m - v1) < abs(v2 - v1):
+                v2 += m
+            parts1[i], parts2[i] = v1, v2
+
+        self.start = np.array(parts1, dtype=np.float64)
+        self.delta = np.array(parts2, dtype=np.float64) - self.start
+        self.mod = np.array(mod, dtype=np.float64)
+        self.modular = np.any(self.mod > 0)
+
+    def __len__(self):
+        return len(self.start)
+
+    def format(self, values):
+        return self.format_str.format(*values)
+
+    def __call__(self, pos):
+        """ Returns the interpolated value string at position pos (between 0.0 and 1.0) """
+        return interpolate_batch([self], [pos])[0]
+
+
+def interpolate_batch(interpolations, positions):
+    """ Interpolates many Interpolation objects at once, each at its own position, 
+        returning a list of value strings.  This does the arithmetic for all of them
+        as single NumPy operations, rather than number-by-number. """
+
+    if not interpolations:
+        return []
+    
+    if len(interpolations) == 1:
+        interpolation = interpolations[0]
+        values = interpolation.start + positions[0] * interpolation.delta
+        if interpolation.modular:
+            mask = interpolation.mod > 0
+            values[mask] %= interpolation.mod[mask]
+        return [ interpolation.format(values.tolist()) ]
+
+    counts = [ len(i) for i in interpolations ]
+    starts = np.concatenate([ i.start for i in interpolations ])
+    deltas = np.concatenate([ i.delta for i in interpolations ])
+    values = starts + np.repeat(positions, counts) * deltas
+
+    if any(i.modular for i in interpolations):
+        mods = np.concatenate([ i.mod for i in interpolations ])
+        mask = mods > 0
+        values[mask] %= mods[mask]
+
+    values = values.tolist()
+    results = []
+    offset = 0
+    for interpolation, count in zip(interpolations, counts):
+        results.append(interpolation.format(values[offset:offset+count]))
+        offset += count
+    return results
+
+
 def interpolate_values(s1, s2, pos, mod=None):
     """ Takes two strings representing values, like "150 150" and "0 0", or
         "rgb(255,255,0)" and "rgb(255,255,100)", and returns an interpolated version
@@ -165,45 +308,160 @@ def interpolate_values(s1, s2, pos, mod=None):
         rotate might be called like so:
         
         result = interpolate_values("0 50 50", "180 50 50", 0.3628, mod=(360,0,0)))
-        
+
+        This parses the strings every time; if you're going to interpolate the same
+        values repeatedly, make an Interpolation object instead.
         """
 
-    splits1 = NUMBER_SPLITTER.split(s1)
-    splits2 = NUMBER_SPLITTER.split(s2)
-    
-    parts1 = [ s for s in splits1 if isfloat(s) ]
-    parts2 = [ s for s in splits2 if isfloat(s) ]
-    
-    if len(parts1) != len(parts2):
-        raise Exception("Cannot interpolate between %s and %s", (s1, s2))
+    return Interpolation(s1, s2, mod)(pos)
 
-    if mod is not None:
-        results = [ interpolate_value_token(t1, t2, pos, m) 
-                    for t1, t2, m in zip(parts1, parts2, mod) ]
-    else:
-        results = [ interpolate_value_token(t1, t2, pos) 
-                        for t1, t2 in zip(parts1, parts2) ]
-
-    result_str = ""
-    for s in splits1:
-        if isfloat(s):
-            result_str += results[0]
-            results = results[1:]
+
+def parse_numbers(s):
+    return [ float(n) for n in NUMBER_SPLITTER.split(s) if isfloat(n) ]
+
+def ease_spline(x1, y1, x2, y2, pos):
+    """ Eases a position between 0.0 and 1.0 according to a keySplines cubic 
+        Bezier with control points (x1, y1) and (x2, y2), by finding (via 
+        bisection) the point on the curve whose x is pos, and returning its y. """
+
+    def bezier(p1, p2, s):
+        return 3 * (1 - s) * (1 - s) * s * p1 + 3 * (1 - s) * s * s * p2 + s * s * s
+
+    low, high = 0.0, 1.0
+    s = pos
+    for _ in range(30):
+        x = bezier(x1, x2, s)
+        if abs(x - pos) < 1e-6:
+            break
+        if x < pos:
+            low = s
+        else:
+            high = s
+        s = (low + high) / 2
+    return bezier(y1, y2, s)
+
+
+# calcMode="paced" is treated as linear; this is so we only say so once
+PACED_WARNED = False
+
+class Keyframes:
+    """ The values an animation goes through over the course of its duration: 
+        either a from/to pair, or a "values" list with optional "keyTimes",
+        interpolated according to "calcMode" (and "keySplines" for spline mode).
+
+        For the linear and spline modes, each pair of adjacent values is pre-parsed
+        into an Interpolation; for discrete mode, each value is held until the next
+        key time.  get_segment() finds the Interpolation and the position within it
+        for a position in the animation as a whole, which lets SnapshotSVG batch
+        up interpolations from many animators at once. """
+
+    def __init__(self, values, key_times=None, calc_mode="linear", key_splines=None, mod=None):
+        global PACED_WARNED
+        if not values:
+            raise Exception("No values to animate between")
+        if calc_mode == "paced":
+            if not PACED_WARNED:
+                logging.warning('calcMode="paced" isn\'t supported, treating it as "linear"')
+                PACED_WARNED = True
+            calc_mode = "linear"
+        self.calc_mode = calc_mode
+        num_values = len(values)
+
+        if calc_mode == "discrete":
+            self.segments = [ Interpolation(v, v, mod) for v in values ]
+            default_key_times = [ i / num_values for i in range(num_values) ]
         else:
-            result_str += s
-    return result_str
+            if num_values == 1:
+                values = values * 2
+                num_values = 2
+            self.segments = [ Interpolation(v1, v2, mod) for v1, v2 in zip(values, values[1:]) ]
+            default_key_times = [ i / (num_values - 1) for i in range(num_values) ]
+
+        self.key_times = key_times if key_times else default_key_times
+        if len(self.key_times) != num_values:
+            raise Exception("Number of keyTimes (%s) doesn't match number of values (%s)" % 
+                                (len(self.key_times), num_values))
+        if any(t1 > t2 for t1, t2 in zip(self.key_times, self.key_times[1:])):
+            raise Exception("keyTimes must be in increasing order: %s" % self.key_times)
+        if self.key_times[0] != 0.0:
+            raise Exception("keyTimes must begin with 0: %s" % self.key_times)
+        if calc_mode != "discrete" and self.key_times[-1] != 1.0:
+            raise Exception("keyTimes must end with 1 (except in discrete mode): %s" % self.key_times)
+
+        self.key_splines = []
+        if calc_mode == "spline":
+            self.key_splines = key_splines or []
+            if len(self.key_splines) != len(self.segments):
+                raise Exception("Number of keySplines (%s) doesn't match number of intervals (%s)" % 
+                                (len(self.key_splines), len(self.segments)))
+
+    def get_segment(self, pos):
+        """ Returns the Interpolation that applies at position pos (between 0.0 
+            and 1.0) in the animation, and the position within that Interpolation """
+
+        i = bisect_right(self.key_times, pos) - 1
+        if self.calc_mode == "discrete":
+            return self.segments[max(i, 0)], 0.0
+
+        i = min(max(i, 0), len(self.segments) - 1)
+        begin, end = self.key_times[i], self.key_times[i+1]
+        local_pos = (pos - begin) / (end - begin) if end > begin else 1.0
+        local_pos = min(max(local_pos, 0.0), 1.0)
+        if self.key_splines:
+            local_pos = ease_spline(*self.key_splines[i], local_pos)
+        return self.segments[i], local_pos
+
+    def __call__(self, pos):
+        """ Returns the value string at position pos (between 0.0 and 1.0) """
+        segment, local_pos = self.get_segment(pos)
+        return segment(local_pos)
+
+
+def get_keyframes(elem, mod=None):
+    """ Makes Keyframes from the from/to or values/keyTimes/calcMode/keySplines
+        attributes of an animation element """
+
+    if "values" in elem.attrib:
+        values = [ v.strip() for v in elem.attrib["values"].split(";") if v.strip() ]
+    else:
+        values = [ elem.attrib["from"], elem.attrib["to"] ]
+
+    key_times = None
+    if "keyTimes" in elem.attrib:
+        key_times = [ float(k) for k in elem.attrib["keyTimes"].split(";") if k.strip() ]
+
+    key_splines = None
+    if "keySplines" in elem.attrib:
+        key_splines = [ parse_numbers(k) for k in elem.attrib["keySplines"].split(";") if k.strip() ]
+        if any(len(k) != 4 for k in key_splines):
+            raise Exception("Each of the keySplines must have four numbers: %s" % elem.attrib["keySplines"])
 
+    calc_mode = elem.attrib.get("calcMode", "linear")
+    return Keyframes(values, key_times, calc_mode, key_splines, mod)
 
-def xpath_id(svg, id):
-    """ Convenience function for finding an xml element with a particular id """
 
-    query = './/*[@id="' + id + '"]'
-    targets = svg.xpath(query)
-    if not targets:
-        raise Exception("No elements found with id=%s" % id)
-    if len(targets) > 1:
-        raise Exception("Multiple elements found with id=%s" % id)
-    return targets[0]
+class ElementIndex:
+    """ An index of the elements of an SVG document by id, built once so that
+        finding an animation's target doesn't mean searching the whole document """
+
+    def __init__(self, svg):
+        self.elements = {}
+        self.duplicates = set()
+        for elem in svg.iter(et.Element):
+            if "id" in elem.attrib:
+                self.add(elem.attrib["id"], elem)
+
+    def add(self, id, elem):
+        if id in self.elements:
+            self.duplicates.add(id)
+        self.elements[id] = elem
+
+    def __getitem__(self, id):
+        if id not in self.elements:
+            raise Exception("No elements found with id=%s" % id)
+        if id in self.duplicates:
+            raise Exception("Multiple elements found with id=%s" % id)
+        return self.elements[id]
 
 
 class Animator:
@@ -211,7 +469,9 @@ class Animator:
         tags like <animate>, <animateTransform>, etc.  Handles parsing of the basic attributes
         and time calculations that are common to all the animation tags. """
 
-    def __init__(self, elem, svg, target_id=""):
+    keyframes = None    # animators that interpolate between values have Keyframes
+
+    def __init__(self, elem, index, target_id=""):
         self.elem = elem
         self.begin = parse_time(elem.attrib["begin"])
         self.dur = parse_time(elem.attrib["dur"])
@@ -222,28 +482,47 @@ class Animator:
         else:
             self.target_id = target_id 
 
-        self.target = xpath_id(svg, self.target_id)
-        self.target_attrib = deepcopy(self.target.attrib)
+        self.target = index[self.target_id]
 
-    def get_target_pos(self):
+    def get_target_pos(self, attrib):
         if self.target.tag == "circle":
             x_label, y_label = "cx", "cy"
         else:
             x_label, y_label = "x", "y"
 
-        return (float(self.target.attrib.get(x_label, 0.0)), 
-                    float(self.target.attrib.get(y_label, 0.0)))
-
-    def reset_target(self):
-        # first reset the attributes
-        for key in self.target.attrib:
-            del self.target.attrib[key]
-        for key, value in self.target_attrib.items():
-            self.target.attrib[key] = value
+        return (float(attrib.get(x_label, 0.0)), 
+                    float(attrib.get(y_label, 0.0)))
 
     def get_target(self):
         return self.target
 
+    def get_active_end(self):
+        """ Returns a time after which this animation can no longer affect
+            the document, or infinity if it can affect it indefinitely (because
+            it repeats indefinitely, or because it's frozen at its last value).
+            
+            This is a conservative bound, used for indexing the animators by 
+            time; it's fine for it to be a little late (e.g. for a fractional
+            repeatCount) since get_time_position() still has the final word on 
+            whether the animation applies. """
+
+        if self.fill == "freeze":
+            return math.inf
+
+        repeat_count = self.elem.attrib.get("repeatCount", "")
+        repeat_dur = self.elem.attrib.get("repeatDur", "")
+        if not repeat_count and not repeat_dur:
+            return self.begin + self.dur
+
+        ends = []
+        if repeat_count and repeat_count != "indefinite":
+            ends.append(self.begin + float(repeat_count) * self.dur)
+        if repeat_dur and repeat_dur != "indefinite":
+            ends.append(self.begin + parse_time(repeat_dur))
+        if not ends:
+            return math.inf
+        return min(ends)
+
     def get_time_position(self, t):
         """ Returns how far along in this animation element is time t, as a
             fraction. For example, if begin=2s and dur=10s, and we're
@@ -290,52 +569,60 @@ class Animator:
         time_position = (time_since_begin % self.dur) / self.dur
         return time_position
 
+    def apply(self, attrib, t):
+        """ Applies the animation at time t to attrib, a dictionary of the 
+            target's attributes.  Returns whether the animation applied. """
+        time_position = self.get_time_position(t)
+        if (time_position < 0): # animation doesn't apply right now
+            return False
+        self.apply_position(attrib, time_position)
+        return True
+
+    def apply_position(self, attrib, time_position, value=None):
+        """ Applies the animation to attrib, a dictionary of the target's 
+            attributes, at a time position given as a fraction as in 
+            get_time_position().  If the animator interpolates values, the 
+            caller can pass in an already-interpolated value. """
+        raise NotImplementedError
+
 class TransformAnimator(Animator):
     """ Interprets the <animateTransform> element """
-    def __init__(self, elem, svg, target_id):
-        Animator.__init__(self, elem, svg, target_id)
+    def __init__(self, elem, index, target_id):
+        Animator.__init__(self, elem, index, target_id)
         self.attrib_name = elem.attrib["attributeName"]
-    
-        self.attrib_from = elem.attrib["from"]
-        self.attrib_to = elem.attrib["to"]
         self.transform_type = elem.attrib["type"]
 
-    def apply(self, t):
+        mod = (360,0,0) if self.transform_type == "rotate" else None
+        self.keyframes = get_keyframes(elem, mod)
 
-        target = self.get_target()
+    def apply_position(self, attrib, time_position, value=None):
 
-        time_position = self.get_time_position(t)
-        if (time_position < 0):
-            return
-
-        if self.transform_type == "rotate":
-            result = interpolate_values(self.attrib_from, self.attrib_to, time_position, (360,0,0))
-        else:
-            result = interpolate_values(self.attrib_from, self.attrib_to, time_position)
-        result = self.transform_type + "(" + result + ")"
+        if value is None:
+            value = self.keyframes(time_position)
+        result = self.transform_type + "(" + value + ")"
 
         if self.transform_type in ["translate", "rotate"]:
             data_attrib_name = "data-motion-" + self.transform_type
-            if  data_attrib_name in target.attrib:
-                target.attrib[data_attrib_name] += " " + result
+            if  data_attrib_name in attrib:
+                attrib[data_attrib_name] += " " + result
             else:
-                target.attrib[data_attrib_name] = result
+                attrib[data_attrib_name] = result
         else:
-            if self.attrib_name in target.attrib:
-                target.attrib[self.attrib_name] += " " + result
+            if self.attrib_name in attrib:
+                attrib[self.attrib_name] += " " + result
             else:
-                target.attrib[self.attrib_name] = result
+                attrib[self.attrib_name] = result
 
 class MotionAnimator(Animator):
     """ Interprets the <animateMotion> element """
-    def __init__(self, elem, svg, target_id):
-        Animator.__init__(self, elem, svg, target_id)
+    def __init__(self, elem, index, target_id, resolution=MOTION_PATH_RESOLUTION):
+        Animator.__init__(self, elem, index, target_id)
 
         self.path = None
         self.path_id = ""
 
         if "path" in elem.attrib:
-            self.path = parse_path_str(elem.attrib["path"])
+            self.path = get_motion_path(elem.attrib["path"], resolution)
         else:
             for child in elem:
                 if child.tag not in MPATH_TAGS:
@@ -343,29 +630,24 @@ class MotionAnimator(Animator):
                 if HREF_TAG not in child.attrib:
                     continue 
                 self.path_id = child.attrib[HREF_TAG].lstrip("#")
+                path_node = index[self.path_id]
+                if "d" not in path_node.attrib:
+                    raise Exception("Target of mpath href must have a 'd' attribute.")
+                self.path = get_motion_path(path_node.attrib["d"], resolution)
                 break
 
         self.attrib_rotate = elem.attrib.get("rotate", "")
 
     
-    def apply(self, t):
-        target = self.get_target()
+    def apply_position(self, attrib, time_position, value=None):
 
-        time_position = self.get_time_position(t)
-        if (time_position < 0):
+        path = self.path
+        if path is None:    # couldn't parse it, see get_motion_path()
             return
-
-        if self.path:
-            path = self.path
-        else:
-            path_node = xpath_id(svg, self.path_id)
-            if "d" not in path_node.attrib:
-                raise Exception("Target of mpath href must have a 'd' attribute.")
-            path = parse_path_str(path_node.attrib["d"])
         
         point = path.point(time_position)
 
-        current_x, current_y = self.get_target_pos()
+        current_x, current_y = self.get_target_pos(attrib)
         value_x = "{:.3f}".format(current_x + point.real)
         value_y = "{:.3f}".format(current_y + point.imag)
 
@@ -374,10 +656,10 @@ class MotionAnimator(Animator):
 
         translate_str = f"translate({value_x} {value_y})"
         
-        if  "data-motion-translate" in target.attrib:
-            target.attrib["data-motion-translate"] += " " + translate_str
+        if  "data-motion-translate" in attrib:
+            attrib["data-motion-translate"] += " " + translate_str
         else:
-            target.attrib["data-motion-translate"] = translate_str
+            attrib["data-motion-translate"] = translate_str
         #if "transform" in target.attrib:
         #    target.attrib["transform"] += " " + translate_str
         #else:
@@ -386,14 +668,7 @@ class MotionAnimator(Animator):
         #print(target.attrib["transform"])
 
         if self.attrib_rotate in ["auto", "auto-reverse"]:
-            if time_position > 0.999:  # don't want nonsense values if we're at the end,
-                current_point = path.point(0.999)            # so back up a weee bit
-                next_point = point
-            else:
-                current_point = point
-                next_point = path.point(time_position + 0.001)
-            angle = math.atan2(next_point.imag - current_point.imag, next_point.real - current_point.real)
-            angle = math.degrees(angle)
+            angle = path.angle(time_position)
             if self.attrib_rotate == "auto-reverse":
                 angle += 180.0
 
@@ -406,64 +681,53 @@ class MotionAnimator(Animator):
             #else:
             #    target.attrib["transform"] = rotate_str
 
-            if  "data-motion-rotate" in target.attrib:
-                target.attrib["data-motion-rotate"] += " " + rotate_str
+            if  "data-motion-rotate" in attrib:
+                attrib["data-motion-rotate"] += " " + rotate_str
             else:
-                target.attrib["data-motion-rotate"] = rotate_str
+                attrib["data-motion-rotate"] = rotate_str
 
 class StaticValueAnimator(Animator):
     """ Interprets the <set> element """
 
-    def __init__(self, elem,  svg, target_id):
-        Animator.__init__(self, elem, svg, target_id)
+    def __init__(self, elem, index, target_id):
+        Animator.__init__(self, elem, index, target_id)
         self.attrib_name = elem.attrib.get("attributeName")
         self.attrib_to = elem.attrib["to"]
 
-    def apply(self, t):
-
-        target = self.get_target()
-        
-        time_position = self.get_time_position(t)
-        if (time_position < 0):  # animation doesn't apply right now
-            return
-        target.attrib[self.attrib_name] = self.attrib_to
+    def apply_position(self, attrib, time_position, value=None):
+        attrib[self.attrib_name] = self.attrib_to
 
         
 class ValueAnimator(Animator):
     """ Interprets the <animate> element """
 
-    def __init__(self, elem, svg, target_id):
-        Animator.__init__(self, elem, svg, target_id)
+    def __init__(self, elem, index, target_id):
+        Animator.__init__(self, elem, index, target_id)
         self.attrib_name = elem.attrib.get("attributeName")
-        self.attrib_from = elem.attrib["from"]
-        self.attrib_to = elem.attrib["to"]
+        self.keyframes = get_keyframes(elem)
         
-    def apply(self, t):
-
-        target = self.get_target()
-
-        time_position = self.get_time_position(t)
-        if (time_position < 0): # animation doesn't apply right now
-            return
-        value = interpolate_values(self.attrib_from, self.attrib_to, time_position)
-        target.attrib[self.attrib_name] = value
+    def apply_position(self, attrib, time_position, value=None):
+        if value is None:
+            value = self.keyframes(time_position)
+        attrib[self.attrib_name] = value
 
-def make_animator(elem, svg, target):
+def make_animator(elem, index, target, motion_resolution=MOTION_PATH_RESOLUTION):
 
     if elem.tag in ANIMATE_TAGS:
-        return ValueAnimator(elem, svg, target)
+        return ValueAnimator(elem, index, target)
     if elem.tag in SET_TAGS:
-        return StaticValueAnimator(elem, svg, target)
+        return StaticValueAnimator(elem, index, target)
     if elem.tag in MOTION_TAGS:
-        return MotionAnimator(elem, svg, target)
+        return MotionAnimator(elem, index, target, motion_resolution)
     if elem.tag in ANIMATE_TRANSFORM_TAGS:
-        return TransformAnimator(elem, svg, target)
+        return TransformAnimator(elem, index, target)
 
     raise Exception("Invalid tag for animation: %s" % elem.tag)
 
 NUM_IDS = 0
+GENERATED_ID_PREFIX = "svgSnapshotElement"    # for animated elements that didn't have an id
 
-def get_animators(elem, svg):
+def get_animators(elem, index, motion_resolution=MOTION_PATH_RESOLUTION):
     global NUM_IDS
 
     animators = []
@@ -472,43 +736,368 @@ def get_animators(elem, svg):
     for child in list(elem):
         if child.tag in ANIMATION_TAGS: 
             if "id" not in elem.attrib:
-                elem.attrib["id"] = "svgSnapshotElement" + str(NUM_IDS)
+                elem.attrib["id"] = GENERATED_ID_PREFIX + str(NUM_IDS)
+                index.add(elem.attrib["id"], elem)
                 NUM_IDS += 1
             elem.remove(child)
-            animator = make_animator(child, svg, elem.attrib["id"])
+            animator = make_animator(child, index, elem.attrib["id"], motion_resolution)
             animators.append(animator)
         else:
-            animators += get_animators(child, svg)
+            animators += get_animators(child, index, motion_resolution)
 
     return animators
 
 
-def motion_compile(elem):
-
-    if "data-motion-translate" in elem.attrib:
-        elem.attrib["transform"] = elem.attrib["data-motion-translate"] + \
-                                " " +  elem.attrib.get("transform", "") 
+class Timeline:
+    """ An index of animators by the interval of time in which they can
+        affect the document, so that we only have to visit the animators that
+        are actually active (or frozen) at a given time, rather than every
+        animator in the document.
+
+        Animators with a short interval are kept in fixed-width time buckets;
+        animators with a very long interval, or that never end (frozen or 
+        indefinitely repeating), are kept in a list sorted by begin time.  
+        Either way, a lookup returns the animators in their original order, 
+        since the order in which animators are applied matters when several 
+        of them target the same attribute. """
+
+    def __init__(self, animators, bucket_size=1.0, max_buckets=64):
+        self.animators = animators
+        self.bucket_size = bucket_size
+        self.buckets = defaultdict(list)
+        self.long_lived = []
+        self.long_lived_begins = []
+        self.intervals = []     # (begin, order, animator, end), sorted by begin
+
+        for order, animator in enumerate(animators):
+            if animator.dur <= 0.0:
+                continue    # never applies, see get_time_position()
+            end = animator.get_active_end()
+            self.intervals.append((animator.begin, order, animator, end))
+            first_bucket = self.get_bucket(animator.begin)
+            if end == math.inf or self.get_bucket(end) - first_bucket >= max_buckets:
+                self.long_lived.append((order, animator, end))
+                continue
+            for bucket in range(first_bucket, self.get_bucket(end) + 1):
+                self.buckets[bucket].append((order, animator, end))
+
+        self.long_lived.sort(key=lambda x: x[1].begin)
+        self.long_lived_begins = [ a.begin for _, a, _ in self.long_lived ]
+        self.intervals.sort(key=lambda x: x[:2])
+
+    def get_bucket(self, t):
+        return math.floor(t / self.bucket_size)
+
+    def __getitem__(self, t):
+        """ Returns the animators that might apply at time t, in the order
+            in which they should be applied """
+
+        results = [ (order, animator) for order, animator, end 
+                        in self.buckets.get(self.get_bucket(t), [])
+                        if animator.begin <= t <= end ]
+        num_begun = bisect_right(self.long_lived_begins, t)
+        results += [ (order, animator) for order, animator, end
+                        in self.long_lived[:num_begun] if t <= end ]
+        results.sort(key=lambda x: x[0])
+        return [ animator for _, animator in results ]
+
+    def sweep(self, times):
+        """ For a sequence of non-decreasing times, yields the animators that might
+            apply at each of them (the same as self[t]).  Rather than looking each
+            time up from scratch, this keeps track of the animators entering and 
+            leaving the active set as time moves forward. """
+
+        active = {}     # order: animator
+        ending = []     # heap of (end, order) for the active animators
+        num_entered = 0
+        for t in times:
+            while num_entered < len(self.intervals) and self.intervals[num_entered][0] <= t:
+                _, order, animator, end = self.intervals[num_entered]
+                active[order] = animator
+                heapq.heappush(ending, (end, order))
+                num_entered += 1
+            while ending and ending[0][0] < t:
+                _, order = heapq.heappop(ending)
+                del active[order]
+            yield [ active[order] for order in sorted(active) ]
+
+
+# the attributes animators keep motion in until motion_compile folds it into 
+# the transform; they're bookkeeping, not changes to how the document looks
+MOTION_ATTRIB_PREFIX = "data-motion-"
+
+def motion_compile(attrib):
+    """ Folds the translations and rotations that animators have accumulated
+        in data-motion-* attributes into the front of the transform attribute. """
+
+    if "data-motion-translate" in attrib:
+        attrib["transform"] = attrib["data-motion-translate"] + \
+                                " " +  attrib.get("transform", "") 
     
-    if "data-motion-rotate" in elem.attrib:
-        elem.attrib["transform"] = elem.attrib["data-motion-rotate"] + \
-                                " " +  elem.attrib.get("transform", "") 
+    if "data-motion-rotate" in attrib:
+        attrib["transform"] = attrib["data-motion-rotate"] + \
+                                " " +  attrib.get("transform", "") 
+
+def get_frame_range(begin, end, fps):
+    """ Returns the indices of the first frame and one past the last frame of
+        video, at fps frames per second, from the frame containing time begin 
+        up to (but not including) time end.  There's always at least one frame. """
+    first_frame = math.floor(begin * fps)
+    last_frame = max(first_frame + 1, math.ceil((end - 0.000001) * fps))
+    return first_frame, last_frame
+
+def get_attribute_deltas(target_id, old_attrib, new_attrib):
+    """ Lists the changes from one set of attributes of an element to another, as 
+        (target_id, attribute name, new value) records; the value is None if the 
+        attribute was removed """
+    deltas = [ (target_id, name, value) for name, value in new_attrib.items()
+                if old_attrib.get(name) != value ]
+    deltas += [ (target_id, name, None) for name in old_attrib if name not in new_attrib ]
+    return deltas
+
+
+class Frame:
+    """ The state of an animated SVG document at a single time, as an overlay of
+        attributes on top of the un-animated document.  Unlike the document that
+        SnapshotSVG[t] returns, a Frame doesn't share anything mutable with the
+        SnapshotSVG it came from, so any number of them can exist at once. """
+
+    def __init__(self, t, template, states):
+        self.t = t
+        self.template = template    # the un-animated document; never modified
+        self.states = states        # target_id: attributes, for animated elements
+
+    def get_attributes(self, elem):
+        """ The attributes of an element of the template in this frame """
+        return self.states.get(elem.attrib.get("id"), elem.attrib)
+
+    def as_svg(self):
+        """ Makes an independent static SVG element for this frame """
+        svg = deepcopy(self.template)
+        if not self.states:
+            return svg
+        for elem in svg.iter(et.Element):
+            attrib = self.states.get(elem.attrib.get("id"))
+            if attrib is not None:
+                elem.attrib.clear()
+                elem.attrib.update(attrib)
+        return svg
 
-    for child in elem:
-        motion_compile(child)
 
 class SnapshotSVG:
+    """ Interprets the animations in an SVG document so that it can be queried
+        by time.  
 
-    def __init__(self, svg):
+        snapshot_svg[t] changes the document itself to its state at time t 
+        and returns it; this is the fastest way to step through an animation, 
+        but there's only one such document, so it isn't safe to use from 
+        more than one thread at a time.  
+
+        snapshot_svg.snapshot(t) doesn't change anything, and returns an 
+        independent Frame; this is safe to use from multiple threads at once. """
+
+    def __init__(self, svg, motion_resolution=MOTION_PATH_RESOLUTION):
         self.svg = svg if isinstance(svg, et._Element) else svg.getroot()
-        self.animators = get_animators(self.svg, self.svg)
+        self.index = ElementIndex(self.svg)
+        self.animators = get_animators(self.svg, self.index, motion_resolution)
         self.animators = sorted(self.animators, key=lambda a:a.begin)
+        self.timeline = Timeline(self.animators)
+
+        # one un-animated copy of the attributes of each target element, shared
+        # by all the animators that target it
+        self.targets = {}
+        self.baselines = {}
+        for animator in self.animators:
+            if animator.target_id not in self.targets:
+                self.targets[animator.target_id] = animator.target
+                self.baselines[animator.target_id] = dict(animator.target.attrib)
+
+        # an un-animated copy of the document, for making independent frames
+        self.template = deepcopy(self.svg)
+
+        self.states = {}    # target_id: attributes, for targets animated in the current snapshot
+        self.changed = []   # target_ids of elements changed by the most recent snapshot
+        self.deltas = []    # (target_id, attribute, value) changes made by the most recent snapshot
+        self.active_animators = []  # the animators, and their time positions,
+        self.positions = []         # that produced the current snapshot
+
+    def get_positions(self, t):
+        """ Returns the animators that might be active at time t, and how far
+            along each of them is (as in Animator.get_time_position) """
+        active_animators = self.timeline[t]
+        positions = [ animator.get_time_position(t) for animator in active_animators ]
+        return active_animators, positions
+
+    def get_states(self, t):
+        """ Calculates the attributes of each animated element at time t, without 
+            changing the document.  Returns a dictionary from target ids to attribute
+            dictionaries; targets that aren't being animated at time t aren't included,
+            their attributes are just their baseline attributes. """
+
+        return self.calculate_states(*self.get_positions(t))
+
+    def calculate_states(self, active_animators, positions):
+
+        # interpolate all the values we need for this frame in one batch
+        interpolating = [ animator for animator, pos in zip(active_animators, positions)
+                            if pos >= 0 and animator.keyframes is not None ]
+        segments = [ animator.keyframes.get_segment(pos) for animator, pos 
+                            in zip(active_animators, positions)
+                            if pos >= 0 and animator.keyframes is not None ]
+        values = interpolate_batch([ interpolation for interpolation, _ in segments ],
+                                    [ local_pos for _, local_pos in segments ])
+        values = dict(zip(interpolating, values))
+
+        states = {}
+        for animator, pos in zip(active_animators, positions):
+            if pos < 0:     # animation doesn't apply right now
+                continue
+            target_id = animator.target_id
+            if target_id not in states:
+                states[target_id] = dict(self.baselines[target_id])
+            animator.apply_position(states[target_id], pos, values.get(animator))
+
+        for attrib in states.values():
+            motion_compile(attrib)
+        return states
+
+    def snapshot(self, t):
+        """ Returns the state of the document at time t as an independent Frame, 
+            without changing the document or anything else shared """
+        return Frame(t, self.template, self.get_states(t))
+
+    def changed_elements(self):
+        """ Returns the elements whose attributes were changed by the most 
+            recent snapshot """
+        return [ self.targets[target_id] for target_id in self.changed ]
+
+    def has_changed(self):
+        """ Returns whether the most recent snapshot differs from the one before it;
+            if not, anything rendered from the previous snapshot can be reused. """
+        return bool(self.changed)
 
     def __getitem__(self, t):    
         """ Gives a static SVG element corresponding to 
         an animated SVG element time t """
-        for animator in self.animators:
-            animator.reset_target()
-        for animator in self.animators:
-            animator.apply(t)
-        motion_compile(self.svg)
-        return self.svg
\ No newline at end of file
+        return self.update(t, self.timeline[t])
+
+    def frames(self, begin, end, fps):
+        """ Steps through the animation in order, one video frame at a time, from 
+            the frame containing time begin up to (but not including) time end.  
+            Yields (frame_idx, svg) pairs, where frame_idx counts frames from time 0 
+            (so the frame's time is frame_idx / fps) and svg is the same document
+            that snapshot_svg[t] gives, so each must be used before asking for the 
+            next.  There's always at least one frame.
+
+            Frame times are calculated from their indices rather than accumulated,
+            so they don't drift, and rather than looking up the active animators
+            from scratch each frame, we sweep through them as time goes on. """
+
+        return self.frame_range(*get_frame_range(begin, end, fps), fps)
+
+    def frame_range(self, first_frame, last_frame, fps):
+        """ Like frames(), but for the frames with indices from first_frame up to 
+            (but not including) last_frame """
+        frame_indices = range(first_frame, last_frame)
+        times = [ frame_idx / fps for frame_idx in frame_indices ]
+        for frame_idx, t, active_animators in zip(frame_indices, times, self.timeline.sweep(times)):
+            yield frame_idx, self.update(t, active_animators)
+
+    def frame_costs(self, first_frame, last_frame, fps):
+        """ Counts the animators that might be active in each frame from first_frame
+            up to (but not including) last_frame, as a rough estimate of how much 
+            work each is, without actually calculating anything """
+        times = [ frame_idx / fps for frame_idx in range(first_frame, last_frame) ]
+        return [ len(active_animators) for active_animators in self.timeline.sweep(times) ]
+
+    def frame_deltas(self, begin, end, fps):
+        """ Like frames(), but yields (frame_idx, deltas) pairs, where deltas lists 
+            the (target_id, attribute, value) changes since the previous frame 
+            (or, for the first frame, since the un-animated document).  Applying 
+            them in order to a copy of the un-animated document (with the ids 
+            SnapshotSVG assigned, as in self.template) reproduces each frame, 
+            apart from the data-motion-* attributes animators use internally. """
+        self.reset()    # so the first frame's deltas start from the un-animated document
+        for frame_idx, _ in self.frames(begin, end, fps):
+            yield frame_idx, self.deltas
+
+    def write_deltas(self, output_path, begin, end, fps):
+        """ Writes the per-frame deltas to a JSON lines file, one line per 
+            frame that changed anything """
+        with open(output_path, "w", encoding="utf-8") as fout:
+            for frame_idx, deltas in self.frame_deltas(begin, end, fps):
+                if not deltas:
+                    continue
+                record = { "frame": frame_idx, "t": round(frame_idx / fps, 6), "deltas": deltas }
+                fout.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def reset(self):
+        """ Puts the document back to its un-animated state """
+        for target_id in self.states:
+            target = self.targets[target_id]
+            target.attrib.clear()
+            target.attrib.update(self.baselines[target_id])
+        self.states = {}
+        self.changed = []
+        self.deltas = []
+        self.active_animators = []
+        self.positions = []
+
+    def update(self, t, active_animators):
+        """ Changes the document to its state at time t, given the animators that
+            might be active then """
+
+        positions = [ animator.get_time_position(t) for animator in active_animators ]
+        if active_animators == self.active_animators and positions == self.positions:
+            # every animation is exactly where it was in the previous snapshot 
+            # (e.g. the only ones left are frozen at their final values, or
+            # nothing is animating at all), so there's nothing to do
+            self.changed = []
+            self.deltas = []
+            return self.svg
+
+        states = self.calculate_states(active_animators, positions)
+
+        # only write the elements whose attributes are different from the 
+        # previous snapshot; elements that stopped being animated go back to 
+        # their baseline attributes
+        self.changed = []
+        self.deltas = []
+        for target_id in list(self.states) + [ i for i in states if i not in self.states ]:
+            baseline = self.baselines[target_id]
+            attrib = states.get(target_id, baseline)
+            previous_attrib = self.states.get(target_id, baseline)
+            if attrib == previous_attrib:
+                continue
+            target = self.targets[target_id]
+            target.attrib.clear()
+            target.attrib.update(attrib)
+            self.changed.append(target_id)
+            self.deltas += [ delta for delta in get_attribute_deltas(target_id, previous_attrib, attrib)
+                                if not delta[1].startswith(MOTION_ATTRIB_PREFIX) ]
+
+        self.states = states
+        self.active_animators = active_animators
+        self.positions = positions
+        return self.svg
+
+
+def main(input_filename, output_filename, svg_filename, begin_time, end_time, fps):
+    svg_tree = et.parse(input_filename)
+    snapshot_svg = SnapshotSVG(svg_tree)
+    if svg_filename:
+        save_xml(svg_filename, snapshot_svg.template)
+    snapshot_svg.write_deltas(output_filename, begin_time, end_time, fps)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write the per-frame attribute changes of an SVG animation to a JSON lines file')
+    parser.add_argument('input', type=str, help='Input .svg file')
+    parser.add_argument('output', type=str, help='Output .jsonl file')
+    parser.add_argument('--svg', type=str, default="", help="Also write the un-animated .svg, with the ids the deltas refer to")
+    parser.add_argument('--begin', type=float, default=0.0, help="Begin time, in seconds [default=0.0]")
+    parser.add_argument('--end', type=float, default=3.0, help="End time, in seconds [default=3.0]")
+    parser.add_argument('--fps', type=int, default=30, help="Frames per second [default=30]")
+    args = parser.parse_args()
+    main(args.input, args.output, args.svg, args.begin, args.end, args.fps)
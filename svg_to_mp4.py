@@ -1,4 +1,4 @@
-from collections import defaultdict 
+from collections import defaultdict, deque
 
 import os, sys
 import argparse
@@ -7,16 +7,30 @@ import re
 import gc
 import logging
 import math
-
+import subprocess
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import ProcessPoolExecutor
+import threading
+import itertools
+
+import numpy as np
 import moviepy.editor as mp
-from svglib.svglib import svg2rlg #, find_font, _registered_fonts 
-from reportlab.graphics import renderPM
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+from PIL import Image
+#from svglib.svglib import find_font, _registered_fonts 
 #from reportlab.pdfbase.pdfmetrics import registerFont, stringWidth
 #from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.colors import toColor
 
-from util import save_xml, load_json
-from svg_snapshot import SnapshotSVG
+from util import load_json
+from svg_snapshot import SnapshotSVG, get_frame_range
+from svg_layers import Layer, get_paint_units, get_layer_runs, get_by_path
+from svg_rasterizers import AnimatedLayer, get_rasterizer
+from render_job import RenderJob, hash_inputs, get_jobs_dir
+from frame_cache import get_frame_cache, get_fingerprint, get_render_settings
+from memory_budget import get_memory_budget
 
 FRAMES_PER_SECOND = 30
 SCREEN_WIDTH_480P = 720
@@ -25,8 +39,48 @@ SCREEN_WIDTH_720P = 1280
 SCREEN_HEIGHT_720P = 720
 SCREEN_WIDTH_HD = 1920
 SCREEN_HEIGHT_HD = 1080
-FRAMES_PER_CHUNK = 240
-CHUNKS_PER_LARGE_CHUNK = 30
+
+# when rendering with several processes, frames are handed out in ranges of 
+# about equal cost, a few ranges per process so that the processes that get
+# cheap ranges can pick up more of them, and no more than so many frames per
+# range so that the results waiting to be encoded don't take up too much memory
+TASKS_PER_WORKER = 4
+MAX_FRAMES_PER_TASK = 60
+FRAME_BASE_COST = 1     # the cost of a frame with no animators, relative to each animator
+
+# with a memory budget, each range of frames is counted as being in memory this
+# many times over per process: being rendered, being sent back, and waiting
+# to be encoded
+TASK_COPIES_PER_WORKER = 3
+WORKER_OVERHEAD_FRAMES = 4    # a worker's renderer (the base, static layers...), in frames
+
+# the parts of the document that don't change for this long are rendered once
+# and reused, and only the rest is rendered every frame
+LAYER_WINDOW_DURATION = 0.5
+
+# long renders are written in chunks of about this many seconds, each its own
+# video, so that a render that stops partway can pick up from the last one
+CHUNK_DURATION = 10.0
+
+# the encoders (for write_video) that make videos that can be joined to ones
+# in each codec without encoding them again
+MATCHING_ENCODERS = { "h264": "libx264", "png": "png" }
+
+# x264 videos get a keyframe at least this often (in seconds), so that where
+# crossfade_videos has to cut one that wasn't written knowing where its fades 
+# would be, it doesn't encode much more than the fades again
+KEYFRAME_INTERVAL = 1.0
+
+VIDEO_STREAM = re.compile(r"Stream #.*?: Video: (\w+)[^,]*, (\w+)")
+
+ENCODER_PRESET = "medium"
+
+# a draft render (to check over the layout, colors and timing of a book before
+# the real thing) is this much smaller, at no more than this many frames per
+# second, and encoded as fast as x264 can
+DRAFT_SCALE = 0.5
+DRAFT_FPS = 12
+DRAFT_PRESET = "ultrafast"
 
 def isfloat(x):
     try:
@@ -50,36 +104,641 @@ def rgb_to_hex(rgb_string):
     return clamp(b) + 2**8 * clamp(g) + 2**16 * clamp(r)
 
 
-NUM_MOVIE_CHUNKS = 0
-NUM_LARGE_CHUNKS = 0
-
-def write_small_chunk(tiff_paths, background_filename, fps):
-    global NUM_MOVIE_CHUNKS
-    tempfile_path = "temp/s_chunk_" + str(NUM_MOVIE_CHUNKS) + ".mp4"
-    NUM_MOVIE_CHUNKS += 1
-    result_clip = mp.ImageSequenceClip(tiff_paths, fps=fps)
-    if background_filename:
-        bgClip = mp.ImageClip(background_filename).set_duration(result_clip.duration)
-        result_clip = mp.CompositeVideoClip([bgClip, result_clip])
-    result_clip.write_videofile(tempfile_path, fps=fps, codec="png") #, threads=4) #, codec="mpeg4")
-    for tiff_path in tiff_paths:
-        os.remove(tiff_path)
-    result_clip.close()
-    return tempfile_path
-
-def write_large_chunk(clip_paths, fps):
-    global NUM_LARGE_CHUNKS
-    tempfile_path = "temp/l_chunk_" + str(NUM_LARGE_CHUNKS) + ".mp4"
-    NUM_LARGE_CHUNKS += 1
-    clips = [mp.VideoFileClip(c) for c in clip_paths]
-    result_clip = mp.concatenate_videoclips(clips, method="compose")
-    result_clip.write_videofile(tempfile_path, fps=fps, codec="png") #, threads=4) #, codec="mpeg4")
-    for clip in clips:
-        clip.close()
-    for clip_path in clip_paths:
-        os.remove(clip_path)
-    result_clip.close()
-    return tempfile_path
+BACKGROUND_CACHE = {}  # (path, modification time, size): background array
+BACKGROUND_CACHE_LOCK = threading.Lock()
+
+def load_background(background_filename, size=None):
+    """ Loads the background image as an RGB array, resized to size (width, height)
+        if given, or None if there isn't one.  Any transparency in the image is over
+        black.  
+        
+        Each image is only decoded once per process; everything using it gets 
+        the same read-only array. """
+    if not background_filename:
+        return None
+    path = os.path.abspath(background_filename)
+    key = (path, os.path.getmtime(path), tuple(size) if size else None)
+    with BACKGROUND_CACHE_LOCK:
+        if key not in BACKGROUND_CACHE:
+            image = Image.open(path).convert("RGBA")
+            black = Image.new("RGBA", image.size, (0, 0, 0, 255))
+            image = Image.alpha_composite(black, image).convert("RGB")
+            if size and image.size != tuple(size):
+                image = image.resize(tuple(size), Image.LANCZOS)
+            background = np.array(image, dtype="uint8")
+            background.flags.writeable = False
+            BACKGROUND_CACHE[key] = background
+        return BACKGROUND_CACHE[key]
+
+def get_background(config):
+    """ The background image in the config, at the configured width and height 
+        (times the configured scale, if any) """
+    size = None
+    if "width" in config and "height" in config:
+        scale = float(config.get("scale", 1))
+        size = (round(float(config["width"]) * scale), round(float(config["height"]) * scale))
+    return load_background(config.get("bg-image", ""), size)
+
+def get_svg_length(value):
+    """ A width or height attribute in pixels, or None if it's in some other unit """
+    try:
+        return float(value[:-2] if value.endswith("px") else value)
+    except ValueError:
+        return None
+
+def scale_svg(svg_tree, scale):
+    """ A copy of an SVG document that renders at scale times its size: its
+        width and height are scaled, and it gets a viewBox of its original size 
+        (if it doesn't have one already), so the drawing scales with them """
+    svg = et.fromstring(et.tostring(svg_tree))
+    width = get_svg_length(svg.attrib.get("width", ""))
+    height = get_svg_length(svg.attrib.get("height", ""))
+    if "viewBox" not in svg.attrib:
+        if not width or not height:
+            logging.warning("Can't scale an SVG without a width and height in pixels "
+                            "or a viewBox; rendering it at its own size")
+            return svg
+        svg.attrib["viewBox"] = f"0 0 {width:g} {height:g}"
+    elif not width or not height:
+        _, _, width, height = [ float(v) for v in svg.attrib["viewBox"].replace(",", " ").split() ]
+    svg.attrib["width"] = str(round(width * scale))
+    svg.attrib["height"] = str(round(height * scale))
+    return svg
+
+def get_draft_config(config, fps):
+    """ A copy of the config for a draft render: smaller (by "draft-scale"), at 
+        a lower frame rate (no more than "draft-fps"), and without the squish 
+        and skew of words as the ball lands on them.  The timing's the same, so
+        the audio still lines up. """
+    draft = dict(config)
+    draft["scale"] = float(config.get("scale", 1)) * float(config.get("draft-scale", DRAFT_SCALE))
+    draft["fps"] = min(fps, config.get("draft-fps", DRAFT_FPS))
+    draft["text-squish"] = 1
+    draft["text-bend"] = 0
+    return draft
+
+def blend(region, rgb, alpha):
+    """ Puts premultiplied colors with the given alpha over an image region, 
+        in place """
+    inverse = 255 - alpha[:,:,np.newaxis].astype(np.uint16)
+    np.minimum(rgb + (region * inverse + 127) // 255, 255, out=region, casting="unsafe")
+
+def composite_layers(base, rasters):
+    """ Puts rendered layers (as from render_layer) over a copy of the base 
+        image, in order """
+    frame = base.copy()
+    for raster in rasters:
+        if raster is None:
+            continue
+        top, left, rgb, alpha = raster
+        region = frame[top:top + rgb.shape[0], left:left + rgb.shape[1]]
+        height, width = region.shape[:2]    # the base might be smaller
+        blend(region, rgb[:height,:width], alpha[:height,:width])
+    return frame
+
+def write_video(frames, output_filename, fps, audio_filename="", codec="libx264", 
+                preset=ENCODER_PRESET, keyframes=()):
+    """ Encodes a sequence of frames (RGB arrays, all the same size) into a video,
+        piping them as raw video into a single ffmpeg process, so that each frame 
+        is encoded exactly once.  The audio (if any) is muxed in by the same process. 
+        For x264, the frames numbered in keyframes (e.g. where fades will end and 
+        start) are keyframes, as well as one every KEYFRAME_INTERVAL seconds. """
+
+    process = None
+    try:
+        for frame in frames:
+            if process is None:
+                height, width = frame.shape[:2]
+                command = [ get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error",
+                            "-f", "rawvideo", "-vcodec", "rawvideo",
+                            "-s", f"{width}x{height}", "-pix_fmt", "rgb24",
+                            "-r", f"{fps}", "-i", "-" ]
+                if audio_filename:
+                    command += [ "-i", audio_filename, "-acodec", "aac", "-shortest" ]
+                command += [ "-vcodec", codec ]
+                if codec == "libx264":
+                    # no B-frames, and keyframes that nothing after them refers back
+                    # past (IDR frames), so the video can be cut at any keyframe and 
+                    # joined to others without encoding it again (see crossfade_videos)
+                    command += [ "-preset", preset, "-pix_fmt", "yuv420p", "-bf", "0",
+                                 "-g", str(max(1, round(fps * KEYFRAME_INTERVAL))), "-forced-idr", "1" ]
+                    if keyframes:
+                        command += [ "-force_key_frames", 
+                                     "expr:" + "+".join(f"eq(n,{k})" for k in sorted(set(keyframes))) ]
+                    if width % 2 or height % 2:
+                        # yuv420p has to be an even number of pixels across and down,
+                        # so an odd last row or column (e.g. from a draft's scale) is 
+                        # cropped off
+                        command += [ "-vf", "crop=trunc(iw/2)*2:trunc(ih/2)*2:0:0" ]
+                command.append(output_filename)
+                process = subprocess.Popen(command, stdin=subprocess.PIPE)
+            try:
+                process.stdin.write(np.ascontiguousarray(frame, dtype="uint8").tobytes())
+            except BrokenPipeError:
+                break   # ffmpeg stopped taking frames, e.g. at the end of the audio
+    finally:
+        if process is not None:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            process.wait()
+
+    if process is None:
+        raise Exception(f"No frames to write to {output_filename}")
+    if process.returncode:
+        raise Exception(f"ffmpeg failed writing {output_filename}")
+    return output_filename
+
+def get_fade_frames(frames_before, frames_after, fade_frames):
+    """ How many frames a sequence of frames_before frames fades into the next
+        one, of frames_after frames, over: fade_frames, unless either is shorter """
+    return min(fade_frames, frames_before, frames_after)
+
+def crossfade_frames(frame_sequences, fade_frames):
+    """ Chains sequences of frames into one, fading each sequence in over the 
+        last fade_frames frames of the one before it (or fewer, as in 
+        get_fade_frames) """
+
+    tail = []   # the last frames of the previous sequence, still to be faded out
+    for frames in frame_sequences:
+        frames = iter(frames)
+        head = list(itertools.islice(frames, fade_frames))
+        num_faded = get_fade_frames(len(tail), len(head), fade_frames)
+        yield from tail[:len(tail) - num_faded]
+        tail = tail[len(tail) - num_faded:]
+        buffer = deque()
+        for frame_idx, frame in enumerate(itertools.chain(head, frames)):
+            if frame_idx < num_faded:
+                opacity = frame_idx / num_faded
+                frame = (tail[frame_idx] * (1.0 - opacity) + frame * opacity).astype("uint8")
+            buffer.append(frame)
+            if len(buffer) > fade_frames:
+                yield buffer.popleft()
+        tail = list(buffer)
+    yield from tail
+
+def get_video_info(filename):
+    """ What it takes to join a video to others: its codec, pixel format and 
+        codec parameters (extradata), size, frame rate, number of frames, which 
+        frames are keyframes, whether frames are stored out of order (B-frames), 
+        and whether it has audio """
+    infos = ffmpeg_parse_infos(filename)
+    ffmpeg = get_setting("FFMPEG_BINARY")
+    header = subprocess.run([ ffmpeg, "-hide_banner", "-i", filename ], 
+                            stdin=subprocess.DEVNULL, stderr=subprocess.PIPE, 
+                            universal_newlines=True).stderr
+    match = VIDEO_STREAM.search(header)
+
+    # list the encoded frames, without decoding them
+    packets = subprocess.run([ ffmpeg, "-nostdin", "-loglevel", "error", "-i", filename, 
+                               "-map", "0:v:0", "-c", "copy", "-f", "framecrc", "-" ],
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+    extradata, keyframes, reordered, num_frames = None, [], False, 0
+    for line in packets.splitlines():
+        if line.startswith("#extradata"):
+            extradata = line.split(":", 1)[1].strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = [ field.strip() for field in line.split(",") ]
+        if fields[1] != fields[2]:      # decoding and presentation times differ
+            reordered = True
+        flags = fields[6] if len(fields) > 6 else None
+        if flags is None or int(flags.split("=")[1], 16) & 1:
+            keyframes.append(num_frames)
+        num_frames += 1
+
+    return { "codec": match.group(1) if match else None,
+             "pix_fmt": match.group(2) if match else None,
+             "extradata": extradata,
+             "size": tuple(infos["video_size"]),
+             "fps": infos["video_fps"],
+             "frames": num_frames,
+             "keyframes": keyframes,
+             "reordered": reordered,
+             "audio": infos["audio_found"] }
+
+def can_join_videos(infos):
+    """ Whether videos (as from get_video_info) are encoded the same way, by an
+        encoder we can use, so that crossfade_videos can copy them """
+    keys = [ (info["codec"], info["pix_fmt"], info["extradata"], info["size"], info["fps"])
+                for info in infos ]
+    return infos[0]["codec"] in MATCHING_ENCODERS and all(key == keys[0] for key in keys)
+
+def read_video(filename, first_frame=0, num_frames=None):
+    """ Decodes a video (as from write_video) back into RGB arrays, one by one,
+        from first_frame on (and only num_frames of them, if given) """
+    infos = ffmpeg_parse_infos(filename)
+    width, height = infos["video_size"]
+    command = [ get_setting("FFMPEG_BINARY"), "-loglevel", "error" ]
+    if first_frame:     # from halfway between frames, so rounding can't get the wrong one
+        command += [ "-ss", f"{(first_frame - 0.5) / infos['video_fps']:.6f}" ]
+    command += [ "-i", filename ]
+    if num_frames is not None:
+        command += [ "-frames:v", str(num_frames) ]
+    command += [ "-f", "rawvideo", "-pix_fmt", "rgb24", "-" ]
+    frame_size = width * height * 3
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            yield np.frombuffer(data, dtype="uint8").reshape((height, width, 3))
+    finally:
+        if process.poll() is None and len(data) == frame_size:
+            process.kill()      # stopped before the end
+        process.stdout.close()
+        process.wait()
+    if process.returncode:
+        raise Exception(f"ffmpeg failed reading {filename}")
+
+def join_videos(segments, list_filename, output_filename, audio_filename=""):
+    """ Puts videos that were encoded the same way (as from write_video) one 
+        after the other, copying the encoded video as it is rather than decoding 
+        and encoding it again, and muxes in the audio (if any).  Each segment is 
+        a filename, or (filename, in point, out point) for part of a video, with
+        the points in seconds and starting on a keyframe. """
+    with open(list_filename, "w", encoding="utf-8") as fout:
+        for segment in segments:
+            filename, inpoint, outpoint = (segment, None, None) if isinstance(segment, str) else segment
+            escaped = os.path.abspath(filename).replace("'", "'\\''")
+            fout.write(f"file '{escaped}'\n")
+            if inpoint is not None:
+                fout.write(f"inpoint {inpoint:.6f}\n")
+            if outpoint is not None:
+                fout.write(f"outpoint {outpoint:.6f}\n")
+    command = [ get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error",
+                "-f", "concat", "-safe", "0", "-i", list_filename ]
+    if audio_filename:
+        command += [ "-i", audio_filename, "-map", "0:v", "-map", "1:a", 
+                     "-acodec", "aac", "-shortest" ]
+    command += [ "-vcodec", "copy", output_filename ]
+    if subprocess.run(command).returncode:
+        raise Exception(f"ffmpeg failed writing {output_filename}")
+    return output_filename
+
+def get_copied_span(info, fade_frames, is_first, is_last):
+    """ The part of a video (as from get_video_info), (first, last) frame, that
+        crossfade_videos can copy as it is: from the first keyframe after the fade
+        into it up to the last keyframe before the fade out of it, or None if 
+        there isn't one """
+    if info["reordered"] and not (is_first and is_last):
+        return None     # can't be cut without getting frames from the wrong side
+    keyframes, num_frames = info["keyframes"], info["frames"]
+    begin = 0 if is_first else next((k for k in keyframes if k >= fade_frames), None)
+    if begin is None:
+        return None
+    if is_last:
+        return begin, num_frames
+    end = max((k for k in keyframes if begin < k <= num_frames - fade_frames), default=None)
+    return None if end is None else (begin, end)
+
+def crossfade_videos(filenames, output_filename, fade_frames, work_dir, audio_filename="", 
+                        infos=None, preset=ENCODER_PRESET):
+    """ Puts videos one after the other, each fading in over the last fade_frames 
+        frames of the one before (as in crossfade_frames), and muxes in the audio
+        (if any).  Only the frames around the fades are decoded and encoded 
+        again; the rest is copied as it is, so the videos have to be encoded
+        the same way (see can_join_videos, and get_video_info for infos), and 
+        with the same preset, for x264. """
+
+    infos = infos or [ get_video_info(filename) for filename in filenames ]
+    if not can_join_videos(infos):
+        raise Exception(f"Can't join videos that aren't encoded the same way: {filenames}")
+    fps = infos[0]["fps"]
+    codec = MATCHING_ENCODERS[infos[0]["codec"]]
+
+    # split the output into spans of videos that can be copied, and runs of 
+    # parts of videos (the ends of one, the beginning of the next, and any 
+    # that are too short to copy any of) that have to be crossfaded and encoded
+    segments = []   # ("copy", filename, first frame, last frame), or ("encode", [ parts ])
+    run = []        # (filename, first frame, number of frames)
+    for idx, (filename, info) in enumerate(zip(filenames, infos)):
+        span = get_copied_span(info, fade_frames, idx == 0, idx == len(filenames) - 1)
+        if span is None:
+            run.append((filename, 0, info["frames"]))
+            continue
+        begin, end = span
+        if begin > 0:
+            run.append((filename, 0, begin))
+        if run:
+            segments.append(("encode", run))
+            run = []
+        segments.append(("copy", filename, begin, end))
+        if end < info["frames"]:
+            run.append((filename, end, info["frames"] - end))
+    if run:
+        segments.append(("encode", run))
+
+    os.makedirs(work_dir, exist_ok=True)
+    join_segments = []
+    for idx, segment in enumerate(segments):
+        if segment[0] == "copy":
+            _, filename, begin, end = segment
+            # rounded so the in point can't land before the first frame, nor the
+            # out point after the last
+            inpoint = math.ceil(begin / fps * 1e6) / 1e6
+            outpoint = math.floor(end / fps * 1e6) / 1e6
+            join_segments.append((filename, inpoint, outpoint))
+            continue
+        frames = crossfade_frames([ read_video(filename, first_frame, num_frames) 
+                                    for filename, first_frame, num_frames in segment[1] ], 
+                                  fade_frames)
+        segment_filename = os.path.join(work_dir, f"fade{idx:04d}.mp4")
+        write_video(frames, segment_filename, fps, codec=codec, preset=preset)
+        if len(segments) > 1 and not can_join_videos([ infos[0], get_video_info(segment_filename) ]):
+            raise Exception(f"Can't join the fades to {filenames[0]}, "
+                            f"it wasn't encoded the same way as write_video does")
+        join_segments.append(segment_filename)
+
+    list_filename = os.path.join(work_dir, "segments.txt")
+    return join_videos(join_segments, list_filename, output_filename, audio_filename)
+
+class FrameRenderer:
+    """ Renders the frames of an SVG animation, as RGB arrays composited over the 
+        background image (if any).
+
+        Frames are rendered a window at a time: the elements that don't change 
+        during the window are rendered once, in layers, and only the layers of
+        elements that do change are rendered each frame and composited in 
+        between. """
+
+    def __init__(self, svg_tree, config, fps):
+        self.snapshot_svg = SnapshotSVG(svg_tree)
+        self.fps = fps
+        self.rasterizer = get_rasterizer(config)
+        bg_rgb = toColor(config.get("bg-color", "rgb(0,0,0)")).bitmap_rgb()
+        self.base = get_background(config)
+        if self.base is None:
+            height, width = self.rasterizer.get_canvas_size(self.snapshot_svg.svg)
+            self.base = np.full((height, width, 3), bg_rgb, dtype="uint8")
+        self.layer_cache = {}   # rasters of static layers in the previous window
+        self.frame_cache = get_frame_cache(config)
+        self.render_settings = get_render_settings(config)
+
+    def render(self, first_frame, last_frame):
+        """ Renders the frames from first_frame up to (but not including) last_frame """
+        window_frames = max(1, round(LAYER_WINDOW_DURATION * self.fps))
+        for window_begin in range(first_frame, last_frame, window_frames):
+            window_end = min(last_frame, window_begin + window_frames)
+            yield from self.render_window(window_begin, window_end)
+
+    def render_window(self, first_frame, last_frame):
+        snapshot_svg = self.snapshot_svg
+
+        # find out which elements change during the window (and, if there's a 
+        # frame cache, what each new frame would look like)
+        states, changed, fingerprints, animated_ids = [], [], [], set()
+        for i, _ in enumerate(snapshot_svg.frame_range(first_frame, last_frame, self.fps)):
+            states.append(snapshot_svg.states)
+            changed.append(i == 0 or snapshot_svg.has_changed())
+            fingerprint = None
+            if self.frame_cache is not None and changed[-1]:
+                fingerprint = get_fingerprint(snapshot_svg.svg, self.render_settings)
+            fingerprints.append(fingerprint)
+            if i > 0:
+                animated_ids.update(snapshot_svg.changed)
+
+        # the layers are only needed if some frame isn't in the cache already
+        layers = base = None
+        if self.frame_cache is None or not all(self.frame_cache.has(fingerprint)
+                                                for fingerprint in fingerprints if fingerprint):
+            base, layers = self.get_layers(animated_ids)
+
+        frame = None
+        for frame_states, frame_changed, fingerprint in zip(states, changed, fingerprints):
+            # if nothing moved since the previous frame (e.g. a pause between
+            # words, or a static cover), it looks exactly the same
+            if frame_changed:
+                frame = self.frame_cache.get(fingerprint) if fingerprint else None
+                if frame is None:
+                    if layers is None:      # it was in the cache, but isn't anymore
+                        base, layers = self.get_layers(animated_ids)
+                    rasters = []
+                    for layer in layers:
+                        if isinstance(layer, AnimatedLayer):
+                            layer = layer.render(frame_states, snapshot_svg.baselines)
+                        rasters.append(layer)
+                    frame = composite_layers(base, rasters)
+                    if fingerprint:
+                        self.frame_cache.put(fingerprint, frame)
+            yield frame
+
+    def get_layers(self, animated_ids):
+        """ Splits the document into layers, given the elements that change during
+            the window, rendering the static ones (or getting them from the previous
+            window); gives back the base image with the static layers below all the 
+            animated ones already on it, and the rest of the layers """
+
+        # the rest look the same in the document now as throughout the window
+        snapshot_svg = self.snapshot_svg
+        svg = snapshot_svg.svg
+        units = get_paint_units(svg, [ snapshot_svg.targets[i] for i in animated_ids ])
+        all_paths = [ path for path, _ in units ]
+        layers = []     # AnimatedLayers to render each frame, and rasters of static layers
+        layer_cache = {}
+        for is_animated, paths in get_layer_runs(units):
+            if is_animated:
+                layer = Layer(svg, paths, all_paths, animated_ids)
+                layers.append(self.rasterizer.animate_layer(layer))
+                continue
+            key = self.get_static_key(svg, paths)
+            if key in self.layer_cache:
+                raster = self.layer_cache[key]
+            else:
+                raster = self.rasterizer.render_layer(Layer(svg, paths, all_paths).svg)
+            layer_cache[key] = raster
+            layers.append(raster)
+        self.layer_cache = layer_cache
+
+        # static layers below all the animated ones can go straight onto the base
+        base = self.base
+        while layers and not isinstance(layers[0], AnimatedLayer):
+            base = composite_layers(base, [ layers.pop(0) ])
+        return base, layers
+
+    def get_static_key(self, svg, paths):
+        """ Identifies how a static layer looks: which elements are in it, and the
+            current attributes of any animated elements in or around them """
+        key = [ tuple(paths) ]
+        for path in paths:
+            elem = get_by_path(svg, path)
+            for related in list(elem.iterancestors()) + list(elem.iter(et.Element)):
+                target_id = related.attrib.get("id")
+                if target_id in self.snapshot_svg.targets:
+                    key.append((target_id, tuple(related.attrib.items())))
+        return tuple(key)
+
+
+WORKER_RENDERER = None  # each worker process's own FrameRenderer
+
+def init_worker(svg_bytes, config, fps):
+    global WORKER_RENDERER
+    # a signal for the whole render (e.g. SIGTERM from a job scheduler, or Ctrl-C)
+    # only goes to the process that started the workers, which stops them in 
+    # between ranges of frames, rather than them dying in the middle of sending 
+    # it frames; but if that process is killed outright, the workers stop too
+    if hasattr(os, "setpgid"):
+        os.setpgid(0, 0)
+    threading.Thread(target=exit_with_parent, daemon=True).start()
+    WORKER_RENDERER = FrameRenderer(et.fromstring(svg_bytes), config, fps)
+
+def exit_with_parent():
+    multiprocessing.connection.wait([ multiprocessing.parent_process().sentinel ])
+    os._exit(1)
+
+def render_task(first_frame, last_frame):
+    # unchanged frames are the same array, which pickle only sends once
+    return list(WORKER_RENDERER.render(first_frame, last_frame))
+
+def split_frames(first_frame, costs, num_tasks, max_frames=MAX_FRAMES_PER_TASK):
+    """ Splits the frames from first_frame on, given the estimated cost of each, 
+        into consecutive (first, last) ranges of about equal cost """
+    target_cost = sum(costs) / num_tasks
+    ranges = []
+    begin, cost = 0, 0
+    for i, frame_cost in enumerate(costs):
+        cost += frame_cost
+        if cost >= target_cost or i + 1 - begin >= max_frames:
+            ranges.append((first_frame + begin, first_frame + i + 1))
+            begin, cost = i + 1, 0
+    if begin < len(costs):
+        ranges.append((first_frame + begin, first_frame + len(costs)))
+    return ranges
+
+def get_frame_size(svg, config):
+    """ The (height, width) of the frames an SVG renders to """
+    background = get_background(config)
+    if background is not None:
+        return background.shape[:2]
+    return get_rasterizer(config).get_canvas_size(svg)
+
+def render_parallel(svg_tree, config, fps, first_frame, last_frame, workers, memory_budget=0):
+    """ Renders frames in a pool of worker processes, each with its own SnapshotSVG,
+        handing out ranges of frames by estimated cost and giving back the frames 
+        in order.  Given a memory budget (in MB), the ranges are made small enough, 
+        and handed out slowly enough, to stay under it. """
+
+    svg_bytes = et.tostring(svg_tree)   # before SnapshotSVG takes the animations out
+
+    snapshot_svg = SnapshotSVG(et.fromstring(svg_bytes))
+    costs = snapshot_svg.frame_costs(first_frame, last_frame, fps)
+    costs = [ FRAME_BASE_COST + cost for cost in costs ]
+
+    budget = get_memory_budget(memory_budget)
+    max_frames, frame_bytes = MAX_FRAMES_PER_TASK, 0
+    if budget is not None:
+        height, width = get_frame_size(snapshot_svg.svg, config)
+        frame_bytes = height * width * 3
+        # each worker starts out as a copy of this process, and then has its own renderer
+        worker_bytes = budget.baseline + frame_bytes * WORKER_OVERHEAD_FRAMES
+        budget_frames = budget.get_frames(frame_bytes, workers * worker_bytes)
+        budget_frames //= workers * TASK_COPIES_PER_WORKER
+        if budget_frames < 1:
+            logging.warning(f"A memory budget of {memory_budget} MB is too small for {workers} "
+                            f"workers at {width}x{height}; rendering a frame at a time")
+        max_frames = max(1, min(max_frames, budget_frames))
+    ranges = split_frames(first_frame, costs, workers * TASKS_PER_WORKER, max_frames)
+
+    # decode the background before starting the workers, so that (where processes
+    # are forked) they start with it already in memory
+    get_background(config)
+
+    # (unlike a multiprocessing.Pool, a ProcessPoolExecutor notices if a worker
+    # is killed, e.g. when it runs out of memory, instead of waiting forever)
+    pool = ProcessPoolExecutor(workers, initializer=init_worker, 
+                                initargs=(svg_bytes, config, fps))
+    try:
+        pending = deque()   # (result, bytes of frames) 
+        in_flight_bytes = 0
+        for frame_range in ranges:
+            task_bytes = (frame_range[1] - frame_range[0]) * frame_bytes
+            # don't get too far ahead of the encoder, or over the memory budget
+            while pending and (len(pending) >= workers * 2 or (budget is not None and 
+                                    not budget.has_room(task_bytes, in_flight_bytes))):
+                result, num_bytes = pending.popleft()
+                in_flight_bytes -= num_bytes
+                yield from result.result()
+            pending.append((pool.submit(render_task, *frame_range), task_bytes))
+            in_flight_bytes += task_bytes
+        while pending:
+            yield from pending.popleft()[0].result()
+    finally:
+        # if we're stopped early, the workers finish the ranges they're on, and
+        # the rest are never started
+        pool.shutdown(cancel_futures=True)
+
+def get_padded_frame_range(begin_time, end_time, padding_duration, fps):
+    """ The frames from begin_time up to end_time (rounded down to a whole frame),
+        plus padding_duration more """
+    end_time_floor = math.floor(end_time * fps) / fps + padding_duration
+    return get_frame_range(begin_time, end_time_floor, fps)
+
+def svg_frames(svg_tree,
+                config,
+                fps,
+                begin_time = 0.0,
+                end_time = 3.0,
+                padding_duration = 0.0,
+                workers = 1,
+                memory_budget = 0):
+    """ Renders an SVG animation frame by frame, giving RGB arrays composited 
+        over the background image (if any), using the given number of processes 
+        (and no more than memory_budget MB, if given) """
+
+    first_frame, last_frame = get_padded_frame_range(begin_time, end_time, padding_duration, fps)
+    yield from render_frames(svg_tree, config, fps, first_frame, last_frame, workers, memory_budget)
+
+def render_frames(svg_tree, config, fps, first_frame, last_frame, workers=1, memory_budget=0):
+    """ Renders the frames from first_frame up to (but not including) last_frame,
+        using the given number of processes """
+    scale = float(config.get("scale", 1))
+    if scale != 1:
+        svg_tree = scale_svg(svg_tree, scale)
+    if workers > 1:
+        yield from render_parallel(svg_tree, config, fps, first_frame, last_frame, 
+                                    workers, memory_budget)
+    else:
+        yield from FrameRenderer(svg_tree, config, fps).render(first_frame, last_frame)
+
+def get_chunks(first_frame, last_frame, fps, chunk_duration=CHUNK_DURATION):
+    """ Splits the frames from first_frame up to last_frame into (first, last) 
+        chunks, always the same way for the same frames """
+    chunk_frames = max(1, round(chunk_duration * fps))
+    return [ (begin, min(begin + chunk_frames, last_frame)) 
+                for begin in range(first_frame, last_frame, chunk_frames) ]
+
+def get_chunk_name(first_frame, last_frame):
+    return f"chunk{first_frame:07d}-{last_frame:07d}.mp4"
+
+def render_chunks(job, svg_tree, config, fps, chunks, workers=1, codec="libx264", memory_budget=0,
+                    preset=ENCODER_PRESET):
+    """ Renders each chunk of frames that isn't already done in the job into
+        its own video, and gives back the filenames of all of them """
+    svg_bytes = et.tostring(svg_tree)   # each run of chunks starts from the same document
+
+    # consecutive chunks that aren't done are rendered in one go, and split 
+    # up as they're encoded
+    pending = [ chunk for chunk in chunks if not job.is_done(get_chunk_name(*chunk)) ]
+    runs = []
+    for chunk in pending:
+        if runs and runs[-1][-1][1] == chunk[0]:
+            runs[-1].append(chunk)
+        else:
+            runs.append([ chunk ])
+
+    for run in runs:
+        frames = render_frames(et.fromstring(svg_bytes), config, fps, 
+                                run[0][0], run[-1][1], workers, memory_budget)
+        for first_frame, last_frame in run:
+            name = get_chunk_name(first_frame, last_frame)
+            write_video(itertools.islice(frames, last_frame - first_frame), 
+                        job.get_partial_path(name), fps, codec=codec, preset=preset)
+            job.mark_done(name, frames=last_frame - first_frame)
+        frames.close()
+
+    return [ job.get_path(get_chunk_name(*chunk)) for chunk in chunks ]
 
 def svg_to_mp4(svg_tree, 
                 audio_filename,
@@ -88,100 +747,49 @@ def svg_to_mp4(svg_tree,
                 begin_time = 0.0,
                 end_time = 3.0, 
                 padding_duration = 0.0,
-                default_length=4.0):
-
-    #clips = []
-    image_paths = []
+                default_length=4.0,
+                workers = 1,
+                memory_budget = 0,
+                work_dir = "",
+                draft = False):
 
     if audio_filename:
         audio_clip = mp.AudioFileClip(audio_filename)
         end_time = audio_clip.duration
-
-    if config_filename:
-        config = load_json(config_filename)
-        background_filename = config.get("bg-image", "")
-        fps = config.get("fps", 30)
-    else:
-        background_filename = ""
-        fps = 30
-
-    frame_duration = 1.0 / fps
-
-    start_time_floor = math.floor(begin_time * fps) / fps
-    end_time_floor = math.floor(end_time * fps) / fps + padding_duration
-    current_time = start_time_floor
-
-    snapshot_svg = SnapshotSVG(svg_tree)
-
-
-    small_chunk_paths = []
-    large_chunk_paths = []
-
-    rgb_str = config.get("bg-color", "rgb(0,0,0)")
-    rgb_int = rgb_to_hex(rgb_str)
-
-    frame_idx = 0
-    while True:
-
-        if len(image_paths) >= FRAMES_PER_CHUNK:
-            small_chunk_path = write_small_chunk(image_paths, background_filename, fps)
-            small_chunk_paths.append(small_chunk_path)
-            image_paths = []
-
-        if len(small_chunk_paths) >= CHUNKS_PER_LARGE_CHUNK:
-            large_chunk_path = write_large_chunk(small_chunk_paths, fps)
-            large_chunk_paths.append(large_chunk_path)
-            small_chunk_paths = []
-
-        frozen_svg = snapshot_svg[current_time]
-        svg_path = f"temp/temp.svg"
-        tiff_path = f"temp/temp.{frame_idx}.tiff"
-
-        save_xml(svg_path, frozen_svg)
-        drawing = svg2rlg(svg_path)
-        renderPM.drawToFile(drawing, tiff_path, fmt="TIFF", bg=rgb_int, configPIL={'transparent': toColor(rgb_str)})
-
-        #imageClip = mp.ImageClip(tempfile_basename + ".png").set_duration(frame_duration)
-        #maskClip = mp.ImageClip(tempfile_basename + ".png", ismask=True)
-        #imageClip.set_mask(maskClip)
-        #renderPM.drawToFile(drawing, tempfile_basename + ".gif", fmt="GIF", bg=0xffff00, configPIL={'transparent': 0xffff00})
-        
-        #p = renderPM.drawToPIL(drawing, bg=0xffffff, configPIL={'transparent': 0xffffff})
-        #p.save(tempfile_basename + ".png")
-        #imageClip = mp.ImageClip(tempfile_basename + ".tiff", transparent=True).set_duration(frame_duration)
-        
-        image_paths.append(tiff_path)
-        current_time += frame_duration
-        frame_idx += 1
-
-        if current_time >= end_time_floor - 0.000001: # tiny adjustment to avoid doubling a frame due to floating point error
-            break
-
-    if image_paths:
-        small_chunk_path = write_small_chunk(image_paths, background_filename, fps)
-        small_chunk_paths.append(small_chunk_path)
-
-    if small_chunk_paths:
-        large_chunk_path = write_large_chunk(small_chunk_paths, fps)
-        large_chunk_paths.append(large_chunk_path)
-
-    movie_chunks = [mp.VideoFileClip(c) for c in large_chunk_paths]
-    result_clip = mp.concatenate_videoclips(movie_chunks, method="compose").set_duration(end_time_floor - start_time_floor)
-    if audio_filename:
-        result_clip.audio = audio_clip
-    result_clip.write_videofile(output_filename, fps=fps) #, codec="mpeg4")
-    for clip in movie_chunks:
-        clip.close()
-    for path in large_chunk_paths:
-        os.remove(path)
-    result_clip.close()
+        audio_clip.close()
+
+    config = load_json(config_filename) if config_filename else {}
+    fps = config.get("fps", 30)
+    preset = ENCODER_PRESET
+    if draft:
+        config = get_draft_config(config, fps)
+        fps, preset = config["fps"], DRAFT_PRESET
+    if memory_budget and workers <= 1:
+        logging.warning("The memory budget only applies with more than one worker; "
+                        "rendering in this process, a frame at a time")
+
+    # the chunks are kept in a job directory until they're all done and joined,
+    # so running this again with the same inputs picks up where it left off
+    first_frame, last_frame = get_padded_frame_range(begin_time, end_time, padding_duration, fps)
+    input_hash = hash_inputs(files=[ audio_filename, config.get("bg-image", "") ],
+                             data=[ et.tostring(svg_tree) ],
+                             settings={ "config": config, "first-frame": first_frame,
+                                        "last-frame": last_frame, "fps": fps, "preset": preset })
+    with RenderJob(input_hash, get_jobs_dir(work_dir)) as job:
+        chunks = get_chunks(first_frame, last_frame, fps)
+        chunk_filenames = render_chunks(job, svg_tree, config, fps, chunks, workers, 
+                                        memory_budget=memory_budget, preset=preset)
+        join_videos(chunk_filenames, job.get_scratch_path("chunks.txt"), 
+                    output_filename, audio_filename)
     return output_filename
 
 
-def main(input_filename, audio_filename, config_filename, output_filename):
+def main(input_filename, audio_filename, config_filename, output_filename, workers=1, 
+            memory_budget=0, work_dir="", draft=False):
 
     svg_tree = et.parse(input_filename)
-    svg_to_mp4(svg_tree, audio_filename, config_filename, output_filename, 24)
+    svg_to_mp4(svg_tree, audio_filename, config_filename, output_filename, 24, 
+                workers=workers, memory_budget=memory_budget, work_dir=work_dir, draft=draft)
 
 
 if __name__ == '__main__':
@@ -191,5 +799,14 @@ if __name__ == '__main__':
     parser.add_argument('output', type=str, help='Output .mp4 file')
     parser.add_argument('audio', type=str, nargs="?", default="", help='Input .mp3 file')
     parser.add_argument('config', type=str, nargs="?", default="", help="Config JSON file")
+    parser.add_argument('--workers', type=int, default=1, help="Number of rendering processes [default=1]")
+    parser.add_argument('--memory-budget', type=float, default=0, 
+                        help="Memory to stay under while rendering, in MB [default: no limit]")
+    parser.add_argument('--work-dir', type=str, default="", 
+                        help="Where to put the files for the render while it's running, or 'tmpfs' "
+                             "for a RAM disk [default=temp/jobs]")
+    parser.add_argument('--draft', action='store_true', 
+                        help="Render a quick, rough draft: smaller, at fewer frames per second")
     args = parser.parse_args()
-    main(args.input, args.audio, args.config, args.output)
+    main(args.input, args.audio, args.config, args.output, args.workers, args.memory_budget,
+         args.work_dir, args.draft)
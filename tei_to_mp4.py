@@ -2,9 +2,12 @@ import os
 import argparse
 import logging
 from tei_to_svg import Slideshow
-from svg_to_mp4 import svg_to_mp4
+from svg_to_mp4 import svg_frames, write_video, crossfade_videos, get_draft_config, \
+                        get_padded_frame_range, ENCODER_PRESET, DRAFT_PRESET
+from sprite_renderer import sprite_frames
 from util import save_xml, load_json, load_xml
 from adjust_timing import adjust_timing
+from render_job import RenderJob, hash_inputs, get_jobs_dir
 import moviepy.editor as mp
 from lxml import etree as et
 
@@ -13,7 +16,11 @@ def tei_to_mp4(input_tei_path,
         input_smil_path, 
         input_audio_path, 
         config_path,
-        output_path):
+        output_path,
+        workers=1,
+        memory_budget=0,
+        work_dir="",
+        draft=False):
 
     # make sure files exist before going through the trouble of rendering
     for path in [input_tei_path, 
@@ -35,6 +42,15 @@ def tei_to_mp4(input_tei_path,
     audio_clip = mp.AudioFileClip(input_audio_path)
     total_duration = audio_clip.duration
     fps = config.get("fps", 60)
+    if draft:
+        config = get_draft_config(config, fps)
+        fps = config["fps"]
+    if memory_budget and config.get("renderer", "svg") == "sprites":
+        logging.warning("The memory budget doesn't apply to the sprites renderer; "
+                        "rendering in this process, a frame at a time")
+    elif memory_budget and workers <= 1:
+        logging.warning("The memory budget only applies with more than one worker; "
+                        "rendering in this process, a frame at a time")
 
     # adjust timing of the SMIL to reflect amplitude
     smil = load_xml(input_smil_path)
@@ -44,40 +60,58 @@ def tei_to_mp4(input_tei_path,
     smil = adjust_timing(smil, smil_dir, bounce_begin, bounce_end)
 
 
-    clips = []
-    current_time = 0
     fade_duration = 0.5
+    fade_frames = round(fade_duration * fps)
 
     # parse the TEI and turn it into a slideshow object
     tree = et.parse(input_tei_path)
-    config = load_json(config_path)
     slideshow = Slideshow(tree.getroot(), config)
     slideshow.layout()
     slideshow.add_all_timestamps(smil)
     slideshow.pad_slides(total_duration)
-    slide_clip_paths = []
-    for slide_idx, slide in enumerate(slideshow.children):
-        subslideshow = Slideshow(tree.getroot(), config)
-        subslideshow.layout()
-        subslideshow.add_all_timestamps(smil)
-        subslideshow.pad_slides(total_duration)
-        svg = subslideshow.asSVG(slide_idx)
-        save_xml(f"temp/slide{slide_idx}.svg", svg)
-        slide_clip_path = f"temp/slide.{slide_idx}.mp4"
-        svg_to_mp4(svg, "", config_path, slide_clip_path, slide.begin_time, slide.end_time, fade_duration)
-        slide_clip_paths.append(slide_clip_path)
 
-    for clip_path in slide_clip_paths:
-        clip = mp.VideoFileClip(clip_path) #.crossfadeout(fade_duration)
-        if current_time != 0:
-            current_time -= fade_duration
-            clip = clip.set_start(current_time).crossfadein(fade_duration)
-        current_time += clip.duration
-        clips.append(clip)
-    
-    video = mp.CompositeVideoClip(clips)
-    video.audio = audio_clip
-    video.write_videofile(output_path, fps=fps, codec="png") #, threads=4)
+    # each slide is rendered into its own clip, kept in a job directory until 
+    # the whole thing is done, so that running this again with the same inputs 
+    # only renders the slides that weren't finished
+    input_hash = hash_inputs(files=[ input_tei_path, input_smil_path, input_audio_path, config_path,
+                                     config.get("bg-image", "") ],
+                             settings={ "draft": draft })
+
+    # slides are kept losslessly, unless it's just a draft
+    codec, preset = ("libx264", DRAFT_PRESET) if draft else ("png", ENCODER_PRESET)
+    with RenderJob(input_hash, get_jobs_dir(work_dir)) as job:
+        clip_paths = []
+        for slide_idx, slide in enumerate(slideshow.children):
+            clip_name = f"slide{slide_idx:04d}.mp4"
+            clip_paths.append(job.get_path(clip_name))
+            if job.is_done(clip_name):
+                continue
+            subslideshow = Slideshow(tree.getroot(), config)
+            subslideshow.layout()
+            subslideshow.add_all_timestamps(smil)
+            subslideshow.pad_slides(total_duration)
+            svg = subslideshow.asSVG(slide_idx)
+            save_xml(job.get_scratch_path(f"slide{slide_idx}.svg"), svg)
+            if config.get("renderer", "svg") == "sprites":
+                frames = sprite_frames(subslideshow.children[slide_idx], svg, config, fps,
+                                            slide.begin_time, slide.end_time, fade_duration)
+            else:
+                frames = svg_frames(svg, config, fps, slide.begin_time, slide.end_time, 
+                                            fade_duration, workers, memory_budget)
+            # with keyframes where the fades into and out of the slide end and 
+            # start, so crossfade_videos only has to encode the fades again
+            first_frame, last_frame = get_padded_frame_range(slide.begin_time, slide.end_time,
+                                                             fade_duration, fps)
+            keyframes = (fade_frames, last_frame - first_frame - fade_frames)
+            write_video(frames, job.get_partial_path(clip_name), fps, codec=codec, preset=preset,
+                        keyframes=keyframes)
+            job.mark_done(clip_name)
+
+        # the clips are crossfaded into each other; only the fades have to be
+        # encoded again, the rest of each clip is copied as it is
+        crossfade_videos(clip_paths, output_path, fade_frames, job.scratch_dir, input_audio_path,
+                         preset=preset)
+    audio_clip.close()
 
 
 if __name__ == '__main__':
@@ -88,9 +122,22 @@ if __name__ == '__main__':
     parser.add_argument('input_audio', type=str, help='Input audio file')
     parser.add_argument('config', type=str, help="Config JSON file")
     parser.add_argument('output', type=str, help='Output MP4 file')
+    parser.add_argument('--workers', type=int, default=1, help="Number of rendering processes [default=1]")
+    parser.add_argument('--memory-budget', type=float, default=0, 
+                        help="Memory to stay under while rendering, in MB [default: no limit]")
+    parser.add_argument('--work-dir', type=str, default="", 
+                        help="Where to put the files for the render while it's running, or 'tmpfs' "
+                             "for a RAM disk [default=temp/jobs]")
+    parser.add_argument('--draft', action='store_true', 
+                        help="Render a quick, rough draft: smaller, at fewer frames per second, "
+                             "and without the squish and skew of the words")
     args = parser.parse_args()
     tei_to_mp4(args.input_tei, 
         args.input_smil, 
         args.input_audio,
         args.config,
-        args.output)
+        args.output,
+        args.workers,
+        args.memory_budget,
+        args.work_dir,
+        args.draft)
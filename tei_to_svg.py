@@ -63,6 +63,25 @@ def get_angle_from_path(path_str, t1, t2):
     angle = math.degrees(angle)
     return angle
 
+def keyframe_animation(tag, attrib_name, keyframes):
+    """ Makes a single animation element that goes through a list of (time, value)
+        keyframes, rather than a chain of separate from/to animations. """
+
+    begin_time = keyframes[0][0]
+    dur = keyframes[-1][0] - begin_time
+    if dur > 0:
+        key_times = [ (time - begin_time) / dur for time, _ in keyframes ]
+    else:
+        key_times = [ i / (len(keyframes) - 1) for i in range(len(keyframes)) ]
+
+    animation = et.Element(tag)
+    animation.attrib["attributeName"] = attrib_name
+    animation.attrib["values"] = ";".join(f"{value}" for _, value in keyframes)
+    animation.attrib["keyTimes"] = ";".join("{:.4f}".format(k) for k in key_times)
+    animation.attrib["begin"] = "{:.3f}s".format(begin_time)
+    animation.attrib["dur"] = "{:.3f}s".format(dur)
+    return animation
+
 
 HUGE_NUMBER = 10000000000000000.0
 
@@ -110,24 +129,13 @@ class BouncingBallBounceAnimation:
 
         #print("begin angle = ", self.angle_begin, ", end angle = ", self.angle_end)
         
-        # squish downward
-        animation = et.Element("animateTransform")
-        animation.attrib["attributeName"] = "transform"
+        # squish downward, then spring back up
+        animation = keyframe_animation("animateTransform", "transform", [
+            (begin_time, "1 1"),
+            (begin_time + half_dur, f"{ball_squish} {ball_squash}"),
+            (end_time, "1 1")
+        ])
         animation.attrib["type"] = "scale"
-        animation.attrib["from"] = "1 1"
-        animation.attrib["to"] = f"{ball_squish} {ball_squash}"
-        animation.attrib["begin"] = "{:.3f}s".format(begin_time)
-        animation.attrib["dur"] = "{:.3f}s".format(half_dur)
-        results.append(animation)
-
-        # spring back up
-        animation = et.Element("animateTransform")
-        animation.attrib["attributeName"] = "transform"
-        animation.attrib["type"] = "scale"
-        animation.attrib["from"] = f"{ball_squish} {ball_squash}"
-        animation.attrib["to"] = "1 1"
-        animation.attrib["begin"] = "{:.3f}s".format(begin_time + half_dur)
-        animation.attrib["dur"] = "{:.3f}s".format(half_dur)
         if self.freeze:
             animation.attrib["fill"] = "freeze"
         results.append(animation)
@@ -135,23 +143,12 @@ class BouncingBallBounceAnimation:
         # move the ball slightly down, otherwise the bottom of the
         # ball actually goes *up* during the bounce.  note that
         # we're in a rotated frame of reference, so down=sideways
-        animation = et.Element("animateTransform")
-        animation.attrib["attributeName"] = "transform"
+        animation = keyframe_animation("animateTransform", "transform", [
+            (begin_time, f"{self.pos.x} {self.pos.y}"),
+            (begin_time + half_dur, f"{self.pos.x + adjust_x} {self.pos.y}"),
+            (end_time, f"{self.pos.x} {self.pos.y}")
+        ])
         animation.attrib["type"] = "translate"
-        animation.attrib["from"] = f"{self.pos.x} {self.pos.y}"
-        animation.attrib["to"] = f"{self.pos.x + adjust_x} {self.pos.y}"
-        animation.attrib["begin"] = "{:.3f}s".format(begin_time)
-        animation.attrib["dur"] = "{:.3f}s".format(half_dur)
-        results.append(animation)        
-
-        
-        animation = et.Element("animateTransform")
-        animation.attrib["attributeName"] = "transform"
-        animation.attrib["type"] = "translate"
-        animation.attrib["from"] = f"{self.pos.x + adjust_x} {self.pos.y}"
-        animation.attrib["to"] = f"{self.pos.x} {self.pos.y}"
-        animation.attrib["begin"] = "{:.3f}s".format(begin_time + half_dur)
-        animation.attrib["dur"] = "{:.3f}s".format(half_dur)
         if self.freeze:
             animation.attrib["fill"] = "freeze"
         results.append(animation)
@@ -259,13 +256,13 @@ class BouncingBallArcAnimation:
         ball_squash_mid = (1 + ball_squash)
 
         
-        animation = et.Element("animateTransform")
-        animation.attrib["attributeName"] = "transform"
+        # stretch out in flight, then back to round on landing
+        animation = keyframe_animation("animateTransform", "transform", [
+            (begin_time, "1 1"),
+            (begin_time + half_dur, f"{ball_squish} {ball_squash}"),
+            (end_time, "1 1")
+        ])
         animation.attrib["type"] = "scale"
-        animation.attrib["from"] = "1 1"
-        animation.attrib["to"] = f"{ball_squish} {ball_squash}"
-        animation.attrib["begin"] = "{:.3f}s".format(begin_time)
-        animation.attrib["dur"] = "{:.3f}s".format(half_dur)
         results.append(animation)
         
         '''
@@ -287,15 +284,6 @@ class BouncingBallArcAnimation:
         animation.attrib["dur"] = "{:.3f}s".format(quarter_dur)
         results.append(animation)
         '''
-        
-        animation = et.Element("animateTransform")
-        animation.attrib["attributeName"] = "transform"
-        animation.attrib["type"] = "scale"
-        animation.attrib["from"] = f"{ball_squish} {ball_squash}"
-        animation.attrib["to"] = "1 1"
-        animation.attrib["begin"] = "{:.3f}s".format(begin_time + half_dur)
-        animation.attrib["dur"] = "{:.3f}s".format(half_dur)
-        results.append(animation)
 
         return results
 
@@ -699,100 +687,39 @@ class Token(RASVComponent):
                 text_squish = self.config.get("text-squish", 1)
                 text_squish_mid = (1 + text_squish) / 2
                 text_bend = self.config.get("text-bend", 0)
-
-                # squish down and left
-                animation = et.Element("animateTransform")
-                animation.attrib["attributeName"] = "transform"
-                animation.attrib["type"] = "scale"
-                animation.attrib["from"] = "1 1"
-                animation.attrib["to"] = f"1 {text_squish_mid}"
-                animation.attrib["begin"] = "{:.3f}s".format(self.begin_time - third_dur)
-                animation.attrib["dur"] = "{:.3f}s".format(third_dur)
-                result.append(animation)
-
-                animation = et.Element("animateTransform")
-                animation.attrib["attributeName"] = "transform"
-                animation.attrib["type"] = "skewX"
-                animation.attrib["from"] = "0"
-                animation.attrib["to"] = f"-{text_bend}"
-                animation.attrib["begin"] = "{:.3f}s".format(self.begin_time - third_dur)
-                animation.attrib["dur"] = "{:.3f}s".format(third_dur)
-                result.append(animation)
-
-                # hold for a moment
-                animation = et.Element("animateTransform")
-                animation.attrib["attributeName"] = "transform"
-                animation.attrib["type"] = "scale"
-                animation.attrib["from"] = f"1 {text_squish_mid}"
-                animation.attrib["to"] = f"1 {text_squish_mid}"
-                animation.attrib["begin"] = "{:.3f}s".format(self.begin_time)
-                animation.attrib["dur"] = "{:.3f}s".format(dur)
-                result.append(animation)
-        
-                animation = et.Element("animateTransform")
-                animation.attrib["attributeName"] = "transform"
-                animation.attrib["type"] = "skewX"
-                animation.attrib["from"] = f"-{text_bend}"
-                animation.attrib["to"] = f"-{text_bend}"
-                animation.attrib["begin"] = "{:.3f}s".format(self.begin_time)
-                animation.attrib["dur"] = "{:.3f}s".format(dur)
-                result.append(animation)
-
-                # squish down and right as the ball is leaving, bringing skew back to 0
-                animation = et.Element("animateTransform")
-                animation.attrib["attributeName"] = "transform"
-                animation.attrib["type"] = "scale"
-                animation.attrib["from"] = f"1 {text_squish_mid}"
-                animation.attrib["to"] = f"1 {text_squish}"
-                animation.attrib["begin"] = "{:.3f}s".format(self.end_time)
-                animation.attrib["dur"] = "{:.3f}s".format(third_dur)
-                result.append(animation)
-        
-                animation = et.Element("animateTransform")
-                animation.attrib["attributeName"] = "transform"
-                animation.attrib["type"] = "skewX"
-                animation.attrib["from"] = f"-{text_bend}"
-                animation.attrib["to"] = "0"
-                animation.attrib["begin"] = "{:.3f}s".format(self.end_time)
-                animation.attrib["dur"] = "{:.3f}s".format(third_dur)
-                result.append(animation)
+                if text_squish == 1 and text_bend == 0:
+                    return result   # nothing to animate, so the text can stay static
+
+                # squish down and left as the ball arrives, hold for a moment,
+                # squish down and right as the ball is leaving (bringing skew 
+                # back to 0), squish up and right as a bounce, and return to normal
+                squish_times = [ self.begin_time - third_dur,
+                                 self.begin_time,
+                                 self.end_time,
+                                 self.end_time + third_dur,
+                                 self.end_time + third_dur * 2,
+                                 self.end_time + third_dur * 3 ]
                 
-                # squish up and right as a bounce
-                animation = et.Element("animateTransform")
-                animation.attrib["attributeName"] = "transform"
+                scales = [ "1 1",
+                           f"1 {text_squish_mid}",
+                           f"1 {text_squish_mid}",
+                           f"1 {text_squish}",
+                           f"1 {text_squish_mid}",
+                           "1 1" ]
+                animation = keyframe_animation("animateTransform", "transform", 
+                                                list(zip(squish_times, scales)))
                 animation.attrib["type"] = "scale"
-                animation.attrib["from"] = f"1 {text_squish}"
-                animation.attrib["to"] = f"1 {text_squish_mid}"
-                animation.attrib["begin"] = "{:.3f}s".format(self.end_time + third_dur)
-                animation.attrib["dur"] = "{:.3f}s".format(third_dur)
-                result.append(animation)
-        
-                animation = et.Element("animateTransform")
-                animation.attrib["attributeName"] = "transform"
-                animation.attrib["type"] = "skewX"
-                animation.attrib["from"] = "0"
-                animation.attrib["to"] = f"{text_bend}"
-                animation.attrib["begin"] = "{:.3f}s".format(self.end_time + third_dur)
-                animation.attrib["dur"] = "{:.3f}s".format(third_dur)
                 result.append(animation)
 
-                # return to normal
-                animation = et.Element("animateTransform")
-                animation.attrib["attributeName"] = "transform"
-                animation.attrib["type"] = "scale"
-                animation.attrib["from"] = f"1 {text_squish_mid}"
-                animation.attrib["to"] = "1 1"
-                animation.attrib["begin"] = "{:.3f}s".format(self.end_time + third_dur * 2)
-                animation.attrib["dur"] = "{:.3f}s".format(third_dur)
-                result.append(animation)
-        
-                animation = et.Element("animateTransform")
-                animation.attrib["attributeName"] = "transform"
+                skews = [ "0",
+                          f"-{text_bend}",
+                          f"-{text_bend}",
+                          "0",
+                          f"{text_bend}",
+                          "0" ]
+                animation = keyframe_animation("animateTransform", "transform", 
+                                                list(zip(squish_times, skews)))
                 animation.attrib["type"] = "skewX"
-                animation.attrib["from"] = f"{text_bend}"
-                animation.attrib["to"] = "0"
-                animation.attrib["begin"] = "{:.3f}s".format(self.end_time + third_dur * 2)
-                animation.attrib["dur"] = "{:.3f}s".format(third_dur)
                 result.append(animation)
 
         return result
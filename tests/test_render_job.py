@@ -0,0 +1,95 @@
+import os
+import sys
+import glob
+import time
+import signal
+import tempfile
+import unittest
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from render_job import lock_file, LOCK_FILENAME, SCRATCH_DIRNAME
+
+# renders 30 seconds of tests/animate_test.svg with 3 worker processes
+RENDER_SCRIPT = """
+import sys
+from lxml import etree as et
+from svg_to_mp4 import svg_to_mp4
+svg_to_mp4(et.parse("tests/animate_test.svg"), "", "", sys.argv[1], 0.0, 30.0,
+           workers=3, work_dir=sys.argv[2])
+"""
+
+TIMEOUT = 60    # seconds
+
+def get_processes(sid):
+    """ The processes (that haven't exited) in a session """
+    pids = []
+    for stat_path in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat_path, "r") as fin:
+                stat = fin.read()
+        except OSError:     # it exited while we were looking
+            continue
+        # pid (name) state ppid pgrp session ..., where the name can have spaces in it
+        fields = stat[stat.rindex(")") + 2:].split()
+        if fields[0] != "Z" and int(fields[3]) == sid:
+            pids.append(int(stat_path.split("/")[2]))
+    return pids
+
+def wait_for(condition, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+@unittest.skipUnless(os.path.isdir("/proc") and hasattr(os, "fork"), "needs /proc and fork")
+class TestSigterm(unittest.TestCase):
+
+    def check_sigterm(self, kill):
+        """ Starts a render with several workers, stops it once it's sending frames
+            to ffmpeg with kill(pid of the render), and checks that every process
+            in it exits, and that it lets go of its job """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            jobs_dir = os.path.join(temp_dir, "jobs")
+            process = subprocess.Popen([ sys.executable, "-c", RENDER_SCRIPT,
+                                         os.path.join(temp_dir, "output.mp4"), jobs_dir ],
+                                       cwd=REPO_DIR, start_new_session=True)
+            try:
+                self.assertTrue(wait_for(lambda: glob.glob(os.path.join(jobs_dir, "*", "partial.*"))))
+                self.assertGreater(len(get_processes(process.pid)), 3)
+
+                kill(process.pid)
+                process.wait(TIMEOUT)
+                self.assertNotEqual(process.returncode, 0)
+                self.assertTrue(wait_for(lambda: not get_processes(process.pid)),
+                                "processes left after SIGTERM")
+            finally:
+                for pid in get_processes(process.pid):
+                    os.kill(pid, signal.SIGKILL)
+                if process.poll() is None:
+                    process.wait()
+
+            # only the finished parts are left, and the job isn't locked
+            job_dir, = glob.glob(os.path.join(jobs_dir, "*"))
+            self.assertFalse(os.path.exists(os.path.join(job_dir, SCRATCH_DIRNAME)))
+            self.assertFalse(glob.glob(os.path.join(job_dir, "partial.*")))
+            fd = os.open(os.path.join(job_dir, LOCK_FILENAME), os.O_RDWR)
+            try:
+                lock_file(fd)   # raises OSError if it's still locked
+            finally:
+                os.close(fd)
+
+    def test_sigterm_main_process(self):
+        self.check_sigterm(lambda pid: os.kill(pid, signal.SIGTERM))
+
+    def test_sigterm_process_group(self):
+        # e.g. from a job scheduler, or `timeout`
+        self.check_sigterm(lambda pid: os.killpg(pid, signal.SIGTERM))
+
+if __name__ == '__main__':
+    unittest.main()